@@ -0,0 +1,281 @@
+"""on_message のホットパスを計測するベンチマーク
+
+Discordには接続せず、Message / Author / Channel の代わりになる簡単なオブジェクトを
+on_message・rate_limiter.check・contains_bad_words・add_xp に流し込み、
+ユーザー数と不適切な単語リストの大きさごとに
+メッセージ数/秒、p50/p99レイテンシ、メモリ確保ブロック数を表示する。
+
+使い方:
+    python bench_on_message.py
+    python bench_on_message.py --messages 20000 --users 100 10000 --bad-words 5 1000 --output bench_output.txt
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# レベルデータなどのファイルは一時ディレクトリに作る
+ORIGINAL_CWD = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bench_on_message_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+
+
+class FakeAvatar:
+    url = "https://example.com/avatar.png"
+
+
+class FakeAuthor:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.created_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.display_avatar = FakeAvatar()
+        self.roles = []
+
+    async def timeout(self, duration, reason=None):
+        pass
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeSentMessage:
+    async def delete(self, delay=None):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+
+    async def send(self, *args, **kwargs):
+        return FakeSentMessage()
+
+    async def delete_messages(self, messages, reason=None):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = "bench"
+        self.member_count = 0
+
+    def get_member(self, user_id):
+        return None
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel, guild):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.mentions = []
+        self.role_mentions = []
+        self.mention_everyone = False
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def delete(self, delay=None):
+        pass
+
+
+def random_word(rng, length):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_bad_words(rng, count):
+    return [random_word(rng, rng.randint(4, 8)) for _ in range(count)]
+
+
+def make_messages(rng, count, user_count, bad_words):
+    guild = FakeGuild(1)
+    channels = [FakeChannel(100 + i) for i in range(10)]
+    authors = {}
+    messages = []
+    for i in range(count):
+        user_id = rng.randrange(user_count) + 1000
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = FakeAuthor(user_id)
+        words = [random_word(rng, rng.randint(2, 9)) for _ in range(rng.randint(3, 20))]
+        # 一部のメッセージには不適切な単語を混ぜる
+        if bad_words and rng.random() < 0.02:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(bad_words))
+        messages.append(FakeMessage(i, " ".join(words), author, rng.choice(channels), guild))
+    return messages
+
+
+MESSAGE_INTERVAL = 0.1  # on_message の計測でメッセージが届く間隔（擬似時計の秒数）
+
+
+def reset_state(bad_words):
+    main.config["bad_words"] = bad_words
+    main.refresh_settings()
+    # 通常の経路を計測するため、チャンネル・サーバー単位の制限は使わない
+    main.rate_limiter = main.RateLimiter({"user": main.DEFAULT_RATE_LIMITS["user"]})
+    main.moderation_warnings.clear()
+    main.bulk_deletes.clear()
+    main.duplicate_detector.guilds.clear()
+    main.mention_tracker.clear()
+    main.auto_reply_fired.clear()
+    main.warning_ledger.clear()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(name, latencies_ns, elapsed, blocks):
+    latencies_ns.sort()
+    count = len(latencies_ns)
+    return {
+        "name": name,
+        "count": count,
+        "per_sec": count / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies_ns, 0.50) / 1000,
+        "p99_us": percentile(latencies_ns, 0.99) / 1000,
+        "blocks_per_call": blocks / count if count else 0.0,
+    }
+
+
+async def measure_async(name, func, items, reset):
+    # 1回目: レイテンシ計測
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter_ns()
+        await func(item)
+        latencies.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - start
+
+    # 2回目: tracemalloc でメモリ確保ブロック数を計測（計測が遅くなるので別に行う）
+    # 1回目と同じ経路を通るよう、送信頻度制限などの状態を戻してから流す
+    reset()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for item in items:
+        await func(item)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "filename"))
+    return summarize(name, latencies, elapsed, blocks)
+
+
+async def noop_process_commands(message):
+    pass
+
+
+async def run_case(rng, message_count, user_count, bad_word_count):
+    bad_words = make_bad_words(rng, bad_word_count)
+    messages = make_messages(rng, message_count, user_count, bad_words)
+    results = []
+
+    def reset():
+        reset_state(bad_words)
+
+    reset_state(bad_words)
+    main.message_pipeline.reset_stats()
+    # 実時間だと一瞬で全員が送信頻度制限にかかるので、サーバー全体で MESSAGE_INTERVAL 秒ごとに届く擬似的な時計を使う
+    message_clock = [time.time()]
+
+    def advance_clock():
+        message_clock[0] += MESSAGE_INTERVAL
+        return message_clock[0]
+    main.message_clock = advance_clock
+    results.append(await measure_async("on_message", main.on_message, messages, reset))
+    stage_stats = main.message_pipeline.stats()
+
+    reset_state(bad_words)
+    clock = [time.time()]
+
+    async def rate_limit_check(message):
+        clock[0] += 0.01
+        main.rate_limiter.check(message, clock[0])
+    results.append(await measure_async("rate_limiter.check", rate_limit_check, messages, reset))
+
+    reset_state(bad_words)
+
+    async def bad_word_check(message):
+        main.contains_bad_words(message.content)
+    results.append(await measure_async("contains_bad_words", bad_word_check, messages, reset))
+
+    async def xp_grant(message):
+        await main.add_xp(message.guild.id, message.author.id, 20)
+    results.append(await measure_async("add_xp", xp_grant, messages, reset))
+
+    # 集計中のXPを反映しておく（次のケースに持ち越さない）
+    await main.xp_aggregator.commit()
+    return results, stage_stats
+
+
+def format_results(message_count, user_count, bad_word_count, results, stage_stats):
+    lines = [
+        f"## messages={message_count} users={user_count} bad_words={bad_word_count}",
+        f"{'stage':<20} {'msg/s':>12} {'p50 (us)':>10} {'p99 (us)':>10} {'blocks/call':>12}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['name']:<20} {r['per_sec']:>12,.0f} {r['p50_us']:>10.1f} {r['p99_us']:>10.1f} {r['blocks_per_call']:>12.2f}"
+        )
+    # on_message の段階ごとの内訳（2回分の実行を合計したもの）
+    lines.append(f"{'  pipeline stage':<20} {'calls':>12} {'hits':>10} {'avg (us)':>10} {'max (us)':>12}")
+    for stats in stage_stats:
+        lines.append(
+            f"{'  ' + stats['name']:<20} {stats['calls']:>12,} {stats['hits']:>10,} {stats['avg_us']:>10.1f} {stats['max_us']:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+async def main_async(args):
+    # コマンド処理はDiscordとの接続が必要なので何もしない関数に差し替える
+    main.bot.process_commands = noop_process_commands
+    rng = random.Random(args.seed)
+    output = []
+    for user_count in args.users:
+        for bad_word_count in args.bad_words:
+            results, stage_stats = await run_case(rng, args.messages, user_count, bad_word_count)
+            text = format_results(args.messages, user_count, bad_word_count, results, stage_stats)
+            print(text + "\n")
+            output.append(text)
+    main.level_stores.close_all()
+    return "\n\n".join(output) + "\n"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="on_message のホットパスを計測します")
+    parser.add_argument("--messages", type=int, default=5000, help="ケースごとのメッセージ数")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 10000], help="送信ユーザー数")
+    parser.add_argument("--bad-words", type=int, nargs="+", default=[5, 1000], help="不適切な単語リストの大きさ")
+    parser.add_argument("--seed", type=int, default=1, help="乱数シード")
+    parser.add_argument("--output", help="結果を書き出すファイル")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.output:
+        args.output = os.path.join(ORIGINAL_CWD, args.output)
+    text = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
@@ -1,24 +1,208 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import json
 import os
 import random
 import datetime
+import sqlite3
+import bisect
+import heapq
+import time
+import asyncio
+import collections
+import re
+import unicodedata
+import copy
+import functools
+import io
+import threading
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import openai
 import deepl
 
+CONFIG_FILE = "config.json"
+
 # 設定ファイルの読み込み
 def load_config():
-    if not os.path.exists("config.json"):
+    if not os.path.exists(CONFIG_FILE):
         return {"allowed_user_ids": []}
-    with open("config.json", "r", encoding="utf-8") as f:
+    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
+def file_mtime(path):
+    # ファイルの更新時刻（ナノ秒）。ファイルがなければ None
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 config = load_config()
 allowed_user_ids = config.get("allowed_user_ids", [])
 
+def write_json_atomic(path, data):
+    # 一時ファイルに書いてから置き換え、書き込み途中の状態を残さない
+    temp_file = path + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temp_file, path)
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+class FileIO:
+    """ファイル入出力をスレッドプールで実行し、同じファイルへのアクセスは順番に処理する"""
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file-io")
+        self.locks = {}  # ファイルパス -> asyncio.Lock
+
+    def lock_for(self, path):
+        path = os.path.abspath(path)
+        lock = self.locks.get(path)
+        if lock is None:
+            lock = self.locks[path] = asyncio.Lock()
+        return lock
+
+    async def run(self, path, func, *args):
+        async with self.lock_for(path):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def write_json(self, path, data):
+        await self.run(path, write_json_atomic, path, data)
+
+    async def read_bytes(self, path):
+        return await self.run(path, read_bytes, path)
+
+file_io = FileIO()
+
+def load_json_file(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_config_file(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_json_atomic(path, data)
+    return file_mtime(path)
+
+CONFIG_VERSION_KEY = "_version"  # config.json に保存する版番号
+
+class ConfigStore:
+    """config.json の唯一の書き込み役。変更は検証してからすぐ設定に反映し、ファイルへは最後の変更から debounce 秒
+    待ってスレッドプールで原子的に書き出す。変更ごとに版番号を進め、直近 history_size 版を残してロールバックできる"""
+
+    def __init__(self, path, data, build, apply, debounce: float = 2, history_size: int = 20):
+        self.path = path
+        self.debounce = debounce  # 最後の変更から書き出すまでの秒数
+        self.data = data  # 現在の設定
+        self.build = build  # 新しい内容から設定を作る関数（不正なら例外を出し、何も変えない）
+        self.apply = apply  # 作った設定を反映する関数
+        self.version = data.get(CONFIG_VERSION_KEY, 0)
+        self.history = collections.deque(maxlen=history_size)  # (版番号, 設定のコピー, 変更理由)
+        self.history.append((self.version, copy.deepcopy(data), "読み込み時の設定"))
+        self.mtime = file_mtime(path)  # 最後に読み書きした時のファイルの更新時刻
+        self.dirty = False  # まだ書き出していない変更があるか
+        self.writing = False
+        self.flush_handle = None  # 書き出しの予約
+        self.flush_task = None
+        self.closed = False
+
+    def update(self, reason, **changes):
+        # 設定を変更して新しい版番号を返す（ファイルへの書き出しは後でまとめて行う）
+        self.commit({**self.data, **changes}, reason)
+        return self.version
+
+    def rollback(self, version):
+        # 履歴に残っている版の内容に戻す（戻したことも新しい版として記録する）
+        for old_version, data, _ in self.history:
+            if old_version == version:
+                self.commit(copy.deepcopy(data), f"v{version} に戻す")
+                return True
+        return False
+
+    def commit(self, data, reason):
+        # 先に設定を作って検証し、成功した時だけ内容を差し替えて版を記録する
+        built = self.build(data)
+        self.version += 1
+        data[CONFIG_VERSION_KEY] = self.version
+        self.data.clear()
+        self.data.update(data)
+        self.history.append((self.version, copy.deepcopy(data), reason))
+        self.apply(built)
+        self.dirty = True
+        # 変更のたびに予約し直し、最後の変更から debounce 秒後に書き出す
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush_handle = asyncio.get_running_loop().call_later(self.debounce, self.start_flush)
+
+    def start_flush(self):
+        self.flush_handle = None
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # 書き込み中に入った変更はもう一度書き出す（書き込み中に変更されないようコピーを渡す）
+        while self.dirty and not self.writing:
+            self.dirty = False
+            self.writing = True
+            try:
+                self.mtime = await file_io.run(self.path, write_config_file, self.path, copy.deepcopy(self.data))
+            except OSError as e:
+                print(f"設定の保存エラー: {e}")
+                self.dirty = True
+                # debounce 秒後に再試行する（書き出せるまでは外部編集の再読み込みも止まるため）
+                if not self.closed and self.flush_handle is None:
+                    self.flush_handle = asyncio.get_running_loop().call_later(self.debounce, self.start_flush)
+                return
+            finally:
+                self.writing = False
+
+    async def reload_if_changed(self):
+        # ファイルが外部で編集されていたら読み直して新しい版として反映する
+        if self.dirty or self.writing:
+            return
+        mtime = await file_io.run(self.path, file_mtime, self.path)
+        if mtime is None or mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            raw = json.loads(await file_io.read_bytes(self.path))
+        except (OSError, ValueError) as e:
+            print(f"config.json の再読み込みエラー（現在の設定を使い続けます）: {e}")
+            return
+        if not isinstance(raw, dict) or self.dirty or self.writing:
+            return
+        raw.pop(CONFIG_VERSION_KEY, None)
+        if raw == {k: v for k, v in self.data.items() if k != CONFIG_VERSION_KEY}:
+            return
+        try:
+            self.commit(raw, "config.json の直接編集")
+        except Exception as e:
+            print(f"config.json の内容を反映できません（現在の設定を使い続けます）: {e}")
+            return
+        print(f"config.json の変更を反映しました (v{self.version})")
+
+    async def close(self):
+        self.closed = True
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        # 書き出し中ならその完了（途中で入った変更の書き出しも含む）を待ってから残りを書き出す
+        if self.flush_task is not None and not self.flush_task.done():
+            await self.flush_task
+        await self.flush()
+
+config_store = ConfigStore(
+    CONFIG_FILE, config,
+    build=lambda data: Settings(data),
+    apply=lambda new_settings: refresh_settings(new_settings)
+)
+
 # OpenAI と DeepL の初期化
 openai_client = None
 deepl_translator = None
@@ -43,13 +227,19 @@ try:
 except Exception as e:
     print(f"DeepL API 初期化エラー: {e}")
 
-LEVEL_DATA_FILE = "level_data.json"  # レベルデータを保存するファイル
+LEVEL_DATA_DIR = "level_data"  # サーバーごとのレベルデータを保存するディレクトリ
+
+# 以下はサーバー別に分割する前の全体共通データ（新しいサーバーの初期データとして取り込む）
+LEVEL_DATA_FILE = "level_data.json"
+LEVEL_JOURNAL_FILE = "level_journal.jsonl"
+LEVEL_JOURNAL_COMPACTING_FILE = "level_journal.compacting.jsonl"
+JOURNAL_SEQ_KEY = "_journal_seq"  # スナップショットに含まれるジャーナルの通し番号
 
-def load_level_data():
-    if not os.path.exists(LEVEL_DATA_FILE):
+def load_level_data(path):
+    if not os.path.exists(path):
         return {}
     try:
-        with open(LEVEL_DATA_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             content = f.read().strip()
             if not content:
                 return {}
@@ -58,40 +248,766 @@ def load_level_data():
         # ファイルが破損している場合は空のデータで初期化
         return {}
 
-def save_level_data(data):
-    with open(LEVEL_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def save_level_data(data, path):
+    write_json_atomic(path, data)
 
-# XPを加算し、レベルアップ判定を行う関数
-def add_xp(user_id, xp):
-    level_data = load_level_data()
-    user_id = str(user_id)  # user_idを文字列に変換
-    if user_id not in level_data:
-        level_data[user_id] = {"level": 1, "xp": 0}
+def read_level_journal(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except (json.JSONDecodeError, ValueError):
+                # 書き込み途中で落ちた最終行などは読み飛ばす
+                continue
+    return records
+
+def apply_xp_record(data, record):
+    user_data = data.get(record["user"], {"level": 1, "xp": 0})
+    level, xp = level_from_total_xp(calculate_total_xp(user_data["level"], user_data["xp"]) + record["xp"])
+    data[record["user"]] = {"level": level, "xp": xp}
+
+# スナップショットにジャーナルを再生して最新のレベルデータを復元する
+def restore_level_data(data_file, journal_file, compacting_file):
+    data = load_level_data(data_file)
+    seq = data.pop(JOURNAL_SEQ_KEY, 0)
+    replayed = []
+    for path in (compacting_file, journal_file):
+        for record in read_level_journal(path):
+            if record["seq"] > seq:
+                apply_xp_record(data, record)
+                seq = record["seq"]
+                replayed.append(record["user"])
+    return data, seq, replayed
+
+def archive_level_journal(path, audit_file):
+    # 圧縮済みのジャーナルを監査ログへ移して削除する
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as src, open(audit_file, "a", encoding="utf-8") as dst:
+        for line in src:
+            dst.write(line)
+    os.remove(path)
+
+legacy_level_data = None
+
+def load_legacy_level_data():
+    """サーバー別に分割する前の全体共通レベルデータを読み込む（一度だけ）"""
+    global legacy_level_data
+    if legacy_level_data is None:
+        legacy_level_data, _, _ = restore_level_data(LEVEL_DATA_FILE, LEVEL_JOURNAL_FILE, LEVEL_JOURNAL_COMPACTING_FILE)
+        legacy_db = config.get("level_database_file", "level_data.db")
+        if os.path.exists(legacy_db):
+            conn = sqlite3.connect(legacy_db)
+            try:
+                for user_id, level, xp in conn.execute("SELECT user_id, level, xp FROM levels"):
+                    legacy_level_data[user_id] = {"level": level, "xp": xp}
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                conn.close()
+    return legacy_level_data
+
+LEGACY_MIGRATION_FILE = os.path.join(LEVEL_DATA_DIR, "legacy_migration.json")  # 分割前のデータを引き継ぐサーバーの一覧
+legacy_migration_guilds = None
+
+def record_legacy_migration_guilds(guild_ids):
+    """分割前のデータを引き継ぐサーバーとして、初めて起動した時点で参加しているサーバーを一度だけ記録する"""
+    global legacy_migration_guilds
+    if not os.path.exists(LEGACY_MIGRATION_FILE):
+        os.makedirs(LEVEL_DATA_DIR, exist_ok=True)
+        write_json_atomic(LEGACY_MIGRATION_FILE, {"guilds": sorted(guild_ids)})
+    legacy_migration_guilds = None  # 次の参照で読み直す
+
+def legacy_level_data_for(guild_id):
+    """このサーバーが引き継ぐ分割前のデータ（記録時に参加していなかったサーバーは空）"""
+    global legacy_migration_guilds
+    if legacy_migration_guilds is None:
+        legacy_migration_guilds = frozenset(load_json_file(LEGACY_MIGRATION_FILE).get("guilds", []))
+    if guild_id not in legacy_migration_guilds:
+        return {}
+    return load_legacy_level_data()
 
-    level_data[user_id]["xp"] += xp
-    current_level = level_data[user_id]["level"]
-    current_xp = level_data[user_id]["xp"]
-    xp_needed_for_next_level = calculate_xp_needed(current_level)
+def release_legacy_level_data():
+    """分割前のデータを引き継ぐサーバーがすべて取り込み終えたら、全体共通データをメモリから捨てる"""
+    global legacy_level_data
+    if legacy_level_data is None or legacy_migration_guilds is None:
+        return
+    if all(os.path.isdir(os.path.join(LEVEL_DATA_DIR, str(guild_id))) for guild_id in legacy_migration_guilds):
+        legacy_level_data = None
+
+class LevelStore:
+    """レベルデータの保存先の共通処理（変更件数・経過時間による書き出し判定など）"""
+
+    def __init__(self, directory: str, flush_interval: float = 30, dirty_threshold: int = 100, guild_id=None):
+        self.directory = directory  # このサーバーのデータを置くディレクトリ
+        self.guild_id = guild_id
+        self.flush_interval = flush_interval  # 定期書き出しの間隔（秒）
+        self.dirty_threshold = dirty_threshold  # この件数の変更が溜まったら書き出し
+        self.dirty = set()
+        self.loaded = False
+        self.last_flush = time.monotonic()
+        self.rank_index = None  # /leaderboard の初回利用時に作成
+
+    def mark_dirty(self, user_id):
+        self.dirty.add(user_id)
+
+    def needs_flush(self):
+        if not self.dirty:
+            return False
+        return len(self.dirty) >= self.dirty_threshold or time.monotonic() - self.last_flush >= self.flush_interval
+
+    async def flush_async(self):
+        self.flush()
+
+    async def get_async(self, user_id):
+        return self.get(user_id)
+
+    async def ranked_async(self):
+        return self.ranked()
+
+class JsonLevelStore(LevelStore):
+    """レベルデータをメモリ上に保持し、XP付与をジャーナルへ追記するストア。
+    スナップショット（level_data.json）への書き出しはバックグラウンドで圧縮としてまとめて行う"""
+
+    def __init__(self, directory: str, flush_interval: float = 30, dirty_threshold: int = 100, guild_id=None):
+        super().__init__(directory, flush_interval, dirty_threshold, guild_id)
+        self.data_file = os.path.join(directory, "level_data.json")
+        self.journal_file = os.path.join(directory, "level_journal.jsonl")
+        self.compacting_file = os.path.join(directory, "level_journal.compacting.jsonl")
+        self.audit_file = os.path.join(directory, "level_journal_audit.jsonl")
+        self.data = {}
+        self.journal = None
+        self.journal_seq = 0
+        self.compacting = False
+        self.compacting_dirty = set()  # 圧縮中のスナップショットに含めた変更（失敗したら dirty に戻す）
+
+    def load(self):
+        # 最初に使われた時に一度だけ読み込み、前回終了後のジャーナルを再生する
+        if self.loaded:
+            return
+        if not os.path.isdir(self.directory):
+            # 分割前から参加していたサーバーは全体データを初期値として引き継ぐ。
+            # 一時ディレクトリにスナップショットを書いてから名前を変えるので、途中で落ちても取り込み前の状態からやり直せる
+            self.data = {user_id: dict(data) for user_id, data in legacy_level_data_for(self.guild_id).items()}
+            seeding_directory = self.directory + ".seeding"
+            if os.path.isdir(seeding_directory):
+                shutil.rmtree(seeding_directory)
+            os.makedirs(seeding_directory)
+            save_level_data(self.snapshot(), os.path.join(seeding_directory, "level_data.json"))
+            os.rename(seeding_directory, self.directory)
+            release_legacy_level_data()
+        else:
+            self.data, self.journal_seq, replayed = restore_level_data(self.data_file, self.journal_file, self.compacting_file)
+            self.dirty.update(replayed)
+            if replayed:
+                print(f"{self.directory}: ジャーナルから {len(replayed)} 件のXP付与を復元しました")
+        self.journal = open(self.journal_file, "a", encoding="utf-8")
+        self.loaded = True
+        if os.path.exists(self.compacting_file):
+            # 圧縮中に停止していた場合は、ここでスナップショットを書き直してから片付ける
+            save_level_data(self.snapshot(), self.data_file)
+            archive_level_journal(self.compacting_file, self.audit_file)
+
+    def get(self, user_id):
+        self.load()
+        return self.data.get(str(user_id), {"level": 1, "xp": 0})
+
+    def update(self, user_id, level, xp, xp_gained, source):
+        self.load()
+        user_id = str(user_id)
+        self.journal_seq += 1
+        record = {"seq": self.journal_seq, "time": time.time(), "user": user_id, "xp": xp_gained, "source": source}
+        self.journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.journal.flush()
+        self.data[user_id] = {"level": level, "xp": xp}
+        self.mark_dirty(user_id)
+
+    def ranked(self):
+        # (ユーザーID, 総XP) を総XPの降順で返す
+        self.load()
+        scores = [
+            (user_id, calculate_total_xp(data["level"], data["xp"]))
+            for user_id, data in self.data.items()
+        ]
+        scores.sort(key=lambda x: x[1], reverse=True)
+        return scores
+
+    def snapshot(self):
+        snapshot = dict(self.data)
+        snapshot[JOURNAL_SEQ_KEY] = self.journal_seq
+        return snapshot
+
+    def begin_compaction(self):
+        # ジャーナルを切り替え、その時点のスナップショットを取る（イベントループ上で実行）
+        if not self.dirty or self.compacting:
+            return None
+        # 前回の圧縮が失敗して .compacting.jsonl が残っている場合は、ジャーナルを切り替えずにそのまま追記を続ける。
+        # スナップショットは今のジャーナルの分まで含むので、残った分は今回、ジャーナルの分は次の圧縮で監査ログへ移る
+        # （復元時は通し番号で取り込み済みの記録を読み飛ばす）
+        if not os.path.exists(self.compacting_file):
+            self.journal.close()
+            try:
+                os.replace(self.journal_file, self.compacting_file)
+            finally:
+                self.journal = open(self.journal_file, "a", encoding="utf-8")
+        self.compacting_dirty, self.dirty = self.dirty, set()
+        self.last_flush = time.monotonic()
+        self.compacting = True
+        return self.snapshot()
+
+    def abort_compaction(self):
+        # 書き出しに失敗したら変更を dirty に戻し、次の圧縮でやり直す（.compacting.jsonl は残したまま）
+        self.dirty |= self.compacting_dirty
+        self.compacting_dirty = set()
+
+    def finish_compaction(self, snapshot):
+        # スナップショットを書き出し、取り込んだジャーナルを監査ログへ移す（別スレッドでも実行可）
+        save_level_data(snapshot, self.data_file)
+        archive_level_journal(self.compacting_file, self.audit_file)
+
+    def flush(self):
+        snapshot = self.begin_compaction()
+        if snapshot is None:
+            return
+        try:
+            self.finish_compaction(snapshot)
+        except BaseException:
+            self.abort_compaction()
+            raise
+        finally:
+            self.compacting = False
+
+    async def flush_async(self):
+        snapshot = self.begin_compaction()
+        if snapshot is None:
+            return
+        try:
+            await file_io.run(self.data_file, self.finish_compaction, snapshot)
+        except BaseException:
+            self.abort_compaction()
+            raise
+        finally:
+            self.compacting = False
+
+    def close(self):
+        if self.journal:
+            self.flush()
+            self.journal.close()
+            self.journal = None
+            self.loaded = False
+
+class SqliteLevelStore(LevelStore):
+    """レベルデータをSQLite（WALモード）に保存するストア。総XP列にインデックスを張る"""
+
+    def __init__(self, directory: str, flush_interval: float = 30, dirty_threshold: int = 100, guild_id=None):
+        super().__init__(directory, flush_interval, dirty_threshold, guild_id)
+        self.path = os.path.join(directory, "level_data.db")
+        self.conn = None
+        self.pending = {}  # まだコミットしていない変更
+        self.pending_events = []  # まだコミットしていないXP付与履歴
+
+    def load(self):
+        if self.loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # 読み込みと書き出しはスレッドプールでも行う（同じファイルへのアクセスは FileIO が直列化する）
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS levels ("
+            "user_id TEXT PRIMARY KEY, level INTEGER NOT NULL, "
+            "xp INTEGER NOT NULL, total_xp INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_levels_total_xp ON levels (total_xp DESC)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS xp_events ("
+            "id INTEGER PRIMARY KEY, created_at REAL NOT NULL, user_id TEXT NOT NULL, "
+            "xp INTEGER NOT NULL, source TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        self.loaded = True
+        self.migrate_legacy()
+        self.recompute_totals()
+
+    def recompute_totals(self):
+        # XPカーブが前回と変わっていたら、保存済みの総XPを今のカーブで計算し直す
+        curve = f"{xp_curve_base}:{xp_curve_exponent}"
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'xp_curve'").fetchone()
+        if row is not None and row[0] == curve:
+            return
+        rows = self.conn.execute("SELECT user_id, level, xp FROM levels").fetchall()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE levels SET total_xp = ? WHERE user_id = ?",
+                [(calculate_total_xp(level, xp), user_id) for user_id, level, xp in rows]
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('xp_curve', ?)", (curve,))
 
-    leveled_up = False
-    new_level = current_level
+    def migrate_legacy(self):
+        # 分割前の全体共通データ（level_data.json など）を一度だけ取り込む（分割前から参加していたサーバーのみ）
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_migrated'").fetchone():
+            return
+        legacy = legacy_level_data_for(self.guild_id)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO levels (user_id, level, xp, total_xp) VALUES (?, ?, ?, ?)",
+                [
+                    (user_id, data["level"], data["xp"], calculate_total_xp(data["level"], data["xp"]))
+                    for user_id, data in legacy.items()
+                ]
+            )
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', ?)", (str(len(legacy)),))
+        release_legacy_level_data()
+        if legacy:
+            print(f"{self.path}: 既存データから {len(legacy)} 件のレベルデータを移行しました")
+
+    def get(self, user_id):
+        self.load()
+        user_id = str(user_id)
+        if user_id in self.pending:
+            return self.pending[user_id]
+        row = self.conn.execute("SELECT level, xp FROM levels WHERE user_id = ?", (user_id,)).fetchone()
+        if not row:
+            return {"level": 1, "xp": 0}
+        return {"level": row[0], "xp": row[1]}
+
+    def update(self, user_id, level, xp, xp_gained, source):
+        self.load()
+        user_id = str(user_id)
+        self.pending[user_id] = {"level": level, "xp": xp}
+        self.pending_events.append((time.time(), user_id, xp_gained, source))
+        self.mark_dirty(user_id)
+
+    async def get_async(self, user_id):
+        # 未コミットの変更はメモリから、それ以外は SQLite からスレッドプールで読む
+        user_id = str(user_id)
+        if user_id in self.pending:
+            return self.pending[user_id]
+        data = await file_io.run(self.path, self.get, user_id)
+        # 読み込み中に更新されていればそちらを使う
+        return self.pending.get(user_id, data)
+
+    def fetch_ranked(self):
+        self.load()
+        return self.conn.execute("SELECT user_id, total_xp FROM levels ORDER BY total_xp DESC").fetchall()
+
+    def ranked(self):
+        # (ユーザーID, 総XP) を総XPの降順で返す（total_xp のインデックスを使用）
+        self.load()
+        self.flush()
+        return self.fetch_ranked()
+
+    async def ranked_async(self):
+        # 書き出しと読み込みはスレッドプールで行い、その間に入った未コミットの変更を重ねる
+        await self.flush_async()
+        totals = dict(await file_io.run(self.path, self.fetch_ranked))
+        for user_id, data in self.pending.items():
+            totals[user_id] = calculate_total_xp(data["level"], data["xp"])
+        return sorted(totals.items(), key=lambda x: x[1], reverse=True)
+
+    def take_batch(self):
+        # コミットする内容を取り出す（コミット完了まで pending は読み取り用に残す）
+        batch = dict(self.pending)
+        rows = [
+            (user_id, data["level"], data["xp"], calculate_total_xp(data["level"], data["xp"]))
+            for user_id, data in batch.items()
+        ]
+        events, self.pending_events = self.pending_events, []
+        self.dirty.clear()
+        self.last_flush = time.monotonic()
+        return batch, rows, events
+
+    def write_batch(self, rows, events):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO levels (user_id, level, xp, total_xp) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET level = excluded.level, xp = excluded.xp, total_xp = excluded.total_xp",
+                rows
+            )
+            self.conn.executemany(
+                "INSERT INTO xp_events (created_at, user_id, xp, source) VALUES (?, ?, ?, ?)",
+                events
+            )
 
-    while current_xp >= xp_needed_for_next_level:
-        current_xp -= xp_needed_for_next_level
-        new_level += 1
-        xp_needed_for_next_level = calculate_xp_needed(new_level)
-        leveled_up = True
+    def restore_batch(self, batch, events):
+        # コミットに失敗したら（database is locked など）取り出した内容を戻し、次回に再試行する
+        self.pending_events[:0] = events
+        self.dirty.update(batch)
+
+    def finish_batch(self, batch):
+        # コミット中に再度更新されたユーザーは次回のコミットまで残す
+        for user_id, data in batch.items():
+            if self.pending.get(user_id) is data:
+                del self.pending[user_id]
+
+    def flush(self):
+        if not self.dirty:
+            return
+        batch, rows, events = self.take_batch()
+        try:
+            self.write_batch(rows, events)
+        except BaseException:
+            self.restore_batch(batch, events)
+            raise
+        self.finish_batch(batch)
+
+    async def flush_async(self):
+        if not self.dirty:
+            return
+        batch, rows, events = self.take_batch()
+        try:
+            await file_io.run(self.path, self.write_batch, rows, events)
+        except BaseException:
+            self.restore_batch(batch, events)
+            raise
+        self.finish_batch(batch)
+
+    def close(self):
+        if self.conn:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+            self.loaded = False
+
+# 設定に応じてレベルデータの保存先を選択（"json" または "sqlite"）
+# レベルデータの保存方式。起動時に Settings で検証した値に置き換え、実行中には変更しない（保存先の形式が変わるため）
+level_storage_backend = "json"
+
+def create_level_store(guild_id):
+    directory = os.path.join(LEVEL_DATA_DIR, str(guild_id))
+    flush_interval = settings.level_flush_interval_seconds
+    dirty_threshold = settings.level_flush_dirty_threshold
+    if level_storage_backend == "sqlite":
+        return SqliteLevelStore(directory, flush_interval, dirty_threshold, guild_id)
+    return JsonLevelStore(directory, flush_interval, dirty_threshold, guild_id)
+
+class LevelStoreManager:
+    """サーバーごとのレベルデータを使う時に読み込み、しばらく使われなければ書き出して解放する"""
+
+    def __init__(self, idle_timeout: float = 600):
+        self.idle_timeout = idle_timeout  # この秒数使われなかったサーバーのデータを解放
+        self.stores = {}  # サーバーID -> ストア
+        self.last_used = {}  # サーバーID -> 最終利用時刻
+
+    async def open(self, guild_id):
+        store = self.stores.get(guild_id)
+        if store is None:
+            store = create_level_store(guild_id)
+            self.stores[guild_id] = store
+        if not store.loaded:
+            # 読み込みはスレッドプールで行う（同時に開かれても読み込みは一度だけ）
+            await file_io.run(store.directory, store.load)
+        self.last_used[guild_id] = time.monotonic()
+        return store
+
+    async def flush_store(self, store):
+        # 書き出しに失敗しても変更はストアに残るので、記録して次回に再試行する
+        try:
+            await store.flush_async()
+        except Exception as e:
+            print(f"レベルデータの書き出しエラー ({store.directory}): {e}")
+            return False
+        return True
 
-    level_data[user_id]["level"] = new_level
-    level_data[user_id]["xp"] = current_xp
-    save_level_data(level_data)
+    async def flush_due(self):
+        for store in list(self.stores.values()):
+            if store.needs_flush():
+                await self.flush_store(store)
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for guild_id in [g for g, used in self.last_used.items() if now - used >= self.idle_timeout]:
+            store = self.stores[guild_id]
+            if not await self.flush_store(store):
+                continue
+            # 書き出し中に再び使われた場合は解放しない
+            if time.monotonic() - self.last_used[guild_id] < self.idle_timeout:
+                continue
+            store.close()
+            del self.stores[guild_id]
+            del self.last_used[guild_id]
+
+    def close_all(self):
+        for store in self.stores.values():
+            try:
+                store.close()
+            except Exception as e:
+                print(f"レベルデータの書き出しエラー ({store.directory}): {e}")
+        self.stores.clear()
+        self.last_used.clear()
+
+level_stores = LevelStoreManager()  # 解放までの秒数は起動時と設定変更時に Settings の値を反映する
+
+class RankIndex:
+    """総XPの降順に並べたユーザー一覧。(-総XP, ユーザーID) を block_size 件前後のブロックに分けた整列リストで持ち、
+    ブロックごとの件数を Fenwick 木で数えるので、更新と順位の計算は O(log n + block_size) で済む"""
+
+    def __init__(self, block_size: int = 256):
+        self.block_size = block_size
+        self.blocks = []  # (-総XP, ユーザーID) の昇順リストを分割したもの
+        self.maxes = []  # 各ブロックの最後の要素
+        self.tree = [0]  # ブロックごとの件数の Fenwick 木（1始まり）
+        self.totals = {}  # ユーザーID -> 総XP
+
+    def __len__(self):
+        return len(self.totals)
+
+    def __contains__(self, user_id):
+        return user_id in self.totals
+
+    def rebuild_tree(self):
+        # ブロックの分割・削除で位置がずれた時に作り直す
+        size = len(self.blocks)
+        tree = [0] * (size + 1)
+        for i, block in enumerate(self.blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def tree_add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def tree_prefix(self, index):
+        # 先頭から index 個のブロックに含まれる件数
+        count = 0
+        while index > 0:
+            count += self.tree[index]
+            index -= index & -index
+        return count
+
+    def load(self, rows):
+        for user_id, total_xp in rows:
+            self.totals[user_id] = total_xp
+        keys = sorted((-total_xp, user_id) for user_id, total_xp in self.totals.items())
+        self.blocks = [keys[i:i + self.block_size] for i in range(0, len(keys), self.block_size)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.rebuild_tree()
+
+    def insert(self, key):
+        if not self.blocks:
+            self.blocks, self.maxes = [[key]], [key]
+            self.rebuild_tree()
+            return
+        index = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block = self.blocks[index]
+        bisect.insort(block, key)
+        self.maxes[index] = block[-1]
+        if len(block) > self.block_size * 2:
+            half = len(block) // 2
+            self.blocks[index:index + 1] = [block[:half], block[half:]]
+            self.maxes[index:index + 1] = [block[half - 1], block[-1]]
+            self.rebuild_tree()
+        else:
+            self.tree_add(index, 1)
+
+    def discard(self, key):
+        index = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[index]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self.maxes[index] = block[-1]
+            self.tree_add(index, -1)
+        else:
+            del self.blocks[index]
+            del self.maxes[index]
+            self.rebuild_tree()
+
+    def update(self, user_id, total_xp):
+        self.remove(user_id)
+        self.insert((-total_xp, user_id))
+        self.totals[user_id] = total_xp
+
+    def remove(self, user_id):
+        old_total = self.totals.pop(user_id, None)
+        if old_total is not None:
+            self.discard((-old_total, user_id))
+
+    def iter_top(self):
+        for block in self.blocks:
+            for negative_total, user_id in block:
+                yield user_id, -negative_total
+
+    def rank(self, user_id):
+        if user_id not in self.totals:
+            return None
+        key = (-self.totals[user_id], user_id)
+        index = bisect.bisect_left(self.maxes, key)
+        return self.tree_prefix(index) + bisect.bisect_left(self.blocks[index], key) + 1
+
+async def get_rank_index(guild):
+    # 初回利用時に作る。サーバーにいない（退出した・他のサーバーから引き継いだ）ユーザーとBotは入れない
+    store = await level_stores.open(guild.id)
+    if store.rank_index is None:
+        rows = await store.ranked_async()
+        rank_index = RankIndex()
+
+        def is_member(user_id):
+            member = guild.get_member(user_id)
+            return member is not None and not member.bot
+        rank_index.load((int(user_id), total_xp) for user_id, total_xp in rows if is_member(int(user_id)))
+        if store.rank_index is None:
+            store.rank_index = rank_index
+    return store.rank_index
+
+# XPを加算し、レベルアップ判定を行う関数（レベルデータはサーバーごと）
+async def add_xp(guild_id, user_id, xp, source="message"):
+    store = await level_stores.open(guild_id)
+    user_data = await store.get_async(user_id)
+
+    current_level = user_data["level"]
+    total_xp = calculate_total_xp(current_level, user_data["xp"]) + xp
+    new_level, current_xp = level_from_total_xp(total_xp)
+
+    store.update(user_id, new_level, current_xp, xp, source)
+    if store.rank_index is not None:
+        store.rank_index.update(int(user_id), total_xp)
+
+    return new_level > current_level, new_level
+
+# 変更件数または経過時間が閾値を超えたらレベルデータを書き出し、使われていないサーバーのデータを解放する
+@tasks.loop(seconds=1)
+async def level_flush_loop():
+    # 例外でループが止まると以後の書き出しと解放が行われなくなるので、記録して続ける
+    try:
+        await level_stores.flush_due()
+        await level_stores.evict_idle()
+    except Exception as e:
+        print(f"レベルデータの定期処理エラー: {e}")
+
+class XpAggregator:
+    """メッセージによるXP付与をユーザーごとのクールダウン付きで集計し、一定間隔でまとめて反映する"""
+
+    def __init__(self, cooldown: float = 60, batch_interval: float = 10):
+        self.cooldown = cooldown  # 同じユーザーにXPを付与する最短間隔（秒）
+        self.batch_interval = batch_interval  # まとめて反映する間隔（秒）
+        self.last_grant = {}  # (サーバーID, ユーザーID) -> 最後に付与した時刻
+        self.pending = {}  # (サーバーID, ユーザーID) -> [XP, チャンネル, メンバー]
+
+    def record(self, message, xp):
+        key = (message.guild.id, message.author.id)
+        now = time.monotonic()
+        last = self.last_grant.get(key)
+        if last is not None and now - last < self.cooldown:
+            return False
+        self.last_grant[key] = now
+
+        entry = self.pending.get(key)
+        if entry:
+            entry[0] += xp
+            entry[1] = message.channel
+            entry[2] = message.author
+        else:
+            self.pending[key] = [xp, message.channel, message.author]
+        return True
+
+    async def commit(self):
+        # 溜まったXPを反映し、レベルアップしたユーザーの一覧を返す
+        pending, self.pending = self.pending, {}
+        level_ups = []
+        for key, entry in pending.items():
+            guild_id, user_id = key
+            xp, channel, member = entry
+            try:
+                leveled_up, new_level = await add_xp(guild_id, user_id, xp)
+            except Exception as e:
+                # 反映できなかった分は次回に持ち越す（他のサーバーの分は続けて反映する）
+                print(f"XPの反映エラー ({guild_id}): {e}")
+                current = self.pending.get(key)
+                if current:
+                    current[0] += xp
+                else:
+                    self.pending[key] = entry
+                continue
+            if leveled_up:
+                level_ups.append((channel, member, new_level))
 
-    return leveled_up, new_level
+        # クールダウンが明けたユーザーは記録から外す
+        now = time.monotonic()
+        for key in [k for k, last in self.last_grant.items() if now - last >= self.cooldown]:
+            del self.last_grant[key]
+        return level_ups
+
+xp_aggregator = XpAggregator()  # クールダウンと反映間隔は起動時と設定変更時に Settings の値を反映する
+
+async def send_levelup_notification(channel, member, new_level):
+    # レベルアップ通知が有効な場合のみ送信
+    if not (await guild_configs.get(member.guild.id)).levelup_notifications:
+        return
+    embed = discord.Embed(
+        title="🎉 レベルアップ！",
+        description=f"{member.mention} がレベル **{new_level}** に到達しました！",
+        color=discord.Color.gold()
+    )
+    embed.set_thumbnail(url=member.display_avatar.url)
+    # 混雑時は後回し・省略してよい通知。同じメンバーの通知が送信待ちなら最新のレベルだけ送る
+    outbound.post(
+        PRIORITY_COSMETIC, ("send", channel.id), channel.send, embed=embed,
+        merge_key=("levelup", member.guild.id, member.id),
+        on_error=lambda e: print(f"レベルアップ通知の送信エラー: {e}")
+    )
+
+# メッセージによるXPをまとめて反映し、反映後にレベルアップ通知を送る
+@tasks.loop(seconds=xp_aggregator.batch_interval)
+async def xp_commit_loop():
+    try:
+        level_ups = await xp_aggregator.commit()
+    except Exception as e:
+        print(f"XPの反映エラー: {e}")
+        return
+    for channel, member, new_level in level_ups:
+        try:
+            await send_levelup_notification(channel, member, new_level)
+        except Exception as e:
+            print(f"レベルアップ通知エラー: {e}")
+
+# XPカーブの設定（必要XP = base * level ** exponent）。起動時に Settings で検証した値に置き換える。
+# 保存済みの総XP（total_xp 列・順位インデックス）がこのカーブで計算されているため、実行中には変更しない
+xp_curve_base = 100
+xp_curve_exponent = 2
+
+# 累積XPテーブル：cumulative_xp_table[i] はレベル i+1 に到達するまでの総XP
+cumulative_xp_table = [0]
 
 # レベルアップに必要なXPを計算する関数
 def calculate_xp_needed(level):
-    return 100 * level ** 2  # 例：レベルが上がるごとに必要なXPが増加
+    return int(xp_curve_base * level ** xp_curve_exponent)  # 例：レベルが上がるごとに必要なXPが増加
+
+# 累積XPテーブルを指定レベルまで伸ばす（レベルデータの読み込みスレッドからも呼ばれる）
+cumulative_xp_lock = threading.Lock()
+
+def extend_cumulative_xp_table(level):
+    if len(cumulative_xp_table) >= level:
+        return
+    with cumulative_xp_lock:
+        while len(cumulative_xp_table) < level:
+            current = len(cumulative_xp_table)
+            cumulative_xp_table.append(cumulative_xp_table[-1] + calculate_xp_needed(current))
+
+# レベル1から指定レベルに到達するまでの総XP
+def cumulative_xp(level):
+    extend_cumulative_xp_table(level)
+    return cumulative_xp_table[level - 1]
+
+# レベルと現在のXPから総XPを計算する関数
+def calculate_total_xp(level, xp):
+    return cumulative_xp(level) + xp
+
+# 総XPから (レベル, 現在のレベル内XP) を二分探索で求める関数
+def level_from_total_xp(total_xp):
+    while cumulative_xp_table[-1] <= total_xp:
+        extend_cumulative_xp_table(len(cumulative_xp_table) * 2)
+    level = bisect.bisect_right(cumulative_xp_table, total_xp)
+    return level, total_xp - cumulative_xp_table[level - 1]
 
 # 新しいチケットシステム
 class TicketView(discord.ui.View):
@@ -172,40 +1088,964 @@ class ConfirmCloseView(discord.ui.View):
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+intents.members = True  # 入退室イベントと、順位インデックスでのメンバー判定に必要（開発者ポータルで Server Members Intent を有効にすること）
+class YukiBot(commands.Bot):
+    async def close(self):
+        # 終了時に集計中のXPを反映し、未保存のデータを書き出す（一部が失敗しても残りの後始末と切断は必ず行う）
+        try:
+            try:
+                await xp_aggregator.commit()
+            except Exception as e:
+                print(f"終了時のXP反映エラー: {e}")
+            for store in list(level_stores.stores.values()):
+                await level_stores.flush_store(store)
+            level_stores.close_all()
+            for name, close in (
+                ("設定", config_store.close),
+                ("サーバー別設定", guild_configs.close),
+                ("警告履歴", warning_ledger.close),
+            ):
+                try:
+                    await close()
+                except Exception as e:
+                    print(f"終了時の{name}の書き出しエラー: {e}")
+        finally:
+            await super().close()
+
+bot = YukiBot(command_prefix="!", intents=intents)
 tree = bot.tree
 
-# メンション回数を追跡する辞書
-mention_count = {}
+class WindowEvents:
+    __slots__ = ("events", "total")
 
-# 荒らし対策用の変数
-user_message_timestamps = {}  # ユーザーの最後のメッセージ時間を追跡
-spam_warnings = {}  # スパム警告回数を追跡
+    def __init__(self):
+        self.events = collections.deque()  # (イベント時刻, 重み)
+        self.total = 0  # events の重みの合計
+
+class SlidingWindowCounter:
+    """キーごとに直近 window 秒のイベント（重み付き）を最大 max_events 件保持し、合計を数える。
+    一定間隔で掃除し、しばらくイベントのないキーはメモリから取り除く"""
+
+    def __init__(self, window: float, max_events: int, sweep_interval: float = 60):
+        self.window = window  # 数える期間（秒）
+        self.max_events = max_events  # キーごとに保持する最大件数
+        self.sweep_interval = sweep_interval  # 掃除の間隔（秒）
+        self.events = {}  # キー -> WindowEvents
+        self.next_sweep = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, key, now, weight=1):
+        # イベントを記録し、直近 window 秒の重みの合計（記録は最新 max_events 件まで）を返す
+        entry = self.events.get(key)
+        if entry is None:
+            entry = self.events[key] = WindowEvents()
+        events = entry.events
+        while events and (now - events[0][0] >= self.window or len(events) >= self.max_events):
+            entry.total -= events.popleft()[1]
+        events.append((now, weight))
+        entry.total += weight
+        if now >= self.next_sweep:
+            self.sweep(now)
+        return entry.total
+
+    def discard(self, key):
+        self.events.pop(key, None)
+
+    def sweep(self, now):
+        for key in [k for k, entry in self.events.items() if not entry.events or now - entry.events[-1][0] >= self.window]:
+            del self.events[key]
+        self.next_sweep = now + self.sweep_interval
+
+    def clear(self):
+        self.events.clear()
+
+class TTLMap:
+    """最後の更新から ttl 秒経った項目を自動的に取り除く辞書"""
+
+    def __init__(self, ttl: float, sweep_interval: float = 60):
+        self.ttl = ttl  # 項目の有効期間（秒）
+        self.sweep_interval = sweep_interval  # 掃除の間隔（秒）
+        self.data = {}  # キー -> (値, 有効期限)
+        self.next_sweep = 0
+
+    def __contains__(self, key):
+        entry = self.data.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.data[key][0]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self.data[key] = (value, now + self.ttl)
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __len__(self):
+        self.sweep(time.monotonic())
+        return len(self.data)
+
+    def sweep(self, now):
+        for key in [k for k, (_, expires) in self.data.items() if expires <= now]:
+            del self.data[key]
+        self.next_sweep = now + self.sweep_interval
+
+    def clear(self):
+        self.data.clear()
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    """ユーザー・チャンネル・サーバー単位のトークンバケットでメッセージの送信頻度を制限する。
+    ポリシーは {"capacity": 最大連投数, "per_seconds": 満タンに戻るまでの秒数}"""
+
+    SCOPES = ("user", "channel", "guild")
+
+    def __init__(self, policies):
+        self.policies = {}  # スコープ -> (容量, 1秒あたりの回復量)
+        self.buckets = {}  # スコープ -> TTLMap(キー -> TokenBucket)
+        for scope in self.SCOPES:
+            policy = policies.get(scope)
+            if policy:
+                self.set_policy(scope, policy["capacity"], policy["per_seconds"])
+
+    def set_policy(self, scope, capacity, per_seconds):
+        if capacity <= 0:
+            self.policies.pop(scope, None)
+            self.buckets.pop(scope, None)
+            return
+        self.policies[scope] = (capacity, capacity / per_seconds)
+        # 満タンまで回復したバケットは持っていなくても同じなので、per_seconds 後に捨てる
+        self.buckets[scope] = TTLMap(ttl=per_seconds)
+
+    def check(self, message, now):
+        # 全スコープのトークンを消費し、超過したスコープ（ユーザー優先）を返す。超過なしは None
+        exceeded = None
+        for scope, key in (("user", message.author.id), ("channel", message.channel.id), ("guild", message.guild.id if message.guild else None)):
+            policy = self.policies.get(scope)
+            if policy is None or key is None:
+                continue
+            capacity, refill_rate = policy
+            buckets = self.buckets[scope]
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(capacity, now)
+            else:
+                bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * refill_rate)
+                bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+            elif exceeded is None:
+                exceeded = scope
+            buckets[key] = bucket
+        return exceeded
+
+DEFAULT_RATE_LIMITS = {
+    "user": {"capacity": 4, "per_seconds": 10},  # 従来の「10秒以内に5回でスパム」に相当
+    # チャンネル・サーバー単位は通常の会話も巻き込むため既定では無効（有効にしても他の兆候がある時だけ削除する）
+    "channel": None,
+    "guild": None
+}
+
+RATE_LIMIT_SCOPE_NAMES = {"user": "ユーザー", "channel": "チャンネル", "guild": "サーバー"}
+
+# 比較用に本文を正規化する（全角半角・大文字小文字・記号・数字・連続文字の違いを無視）
+NON_LETTER_PATTERN = re.compile(r"[\W\d_]+")
+REPEATED_CHAR_PATTERN = re.compile(r"(.)\1+")
+
+def normalize_message_content(content):
+    text = unicodedata.normalize("NFKC", content).lower()
+    text = NON_LETTER_PATTERN.sub("", text)
+    return REPEATED_CHAR_PATTERN.sub(r"\1", text)
+
+class DuplicateMessageDetector:
+    """同じ（ほぼ同じ）内容が短時間に複数アカウントから投稿されたことをサーバーごとに検出する"""
+
+    def __init__(self, threshold: int = 4, window: float = 30, min_length: int = 8, max_fingerprints: int = 5000):
+        self.threshold = threshold  # この人数以上が同じ内容を投稿したら検出
+        self.window = window  # 数える期間（秒）
+        self.min_length = min_length  # 正規化後にこれより短い本文は対象外（挨拶など）
+        self.max_fingerprints = max_fingerprints  # サーバーごとに保持する指紋の上限
+        self.guilds = {}  # サーバーID -> OrderedDict(指紋 -> [最終投稿時刻, {ユーザーID: 投稿時刻}])
+
+    def check(self, message, now):
+        # 同じ内容を投稿したアカウント数が閾値以上なら True
+        normalized = normalize_message_content(message.content)
+        if len(normalized) < self.min_length:
+            return False
+        fingerprint = hash(normalized)
+
+        recent = self.guilds.get(message.guild.id)
+        if recent is None:
+            recent = self.guilds[message.guild.id] = collections.OrderedDict()
+
+        # 期限切れ・上限超過の指紋を古い順に捨てる
+        while recent:
+            oldest = next(iter(recent.values()))
+            if now - oldest[0] < self.window and len(recent) < self.max_fingerprints:
+                break
+            recent.popitem(last=False)
+
+        entry = recent.get(fingerprint)
+        if entry is None:
+            entry = recent[fingerprint] = [now, {}]
+        else:
+            recent.move_to_end(fingerprint)
+            entry[0] = now
+        authors = entry[1]
+        authors[message.author.id] = now
+        if len(authors) > self.threshold * 4:
+            # 投稿者の記録も上限を設け、古いものから捨てる
+            del authors[next(iter(authors))]
+        if len(authors) < self.threshold:
+            return False
+        return sum(1 for posted in authors.values() if now - posted < self.window) >= self.threshold
+
+
+class RaidDetector:
+    """サーバーごとの参加ペースを監視し、急増したら一定時間「レイドモード」にする"""
+
+    def __init__(self, threshold: int = 10, window: float = 10, duration: float = 300, max_queue: int = 5000):
+        self.threshold = threshold  # window 秒以内にこの人数が参加したらレイドモード
+        self.duration = duration  # 最後の参加からレイドモードを続ける秒数
+        self.max_queue = max_queue  # まとめて処理する参加者の上限
+        self.joins = SlidingWindowCounter(window=window, max_events=threshold)
+        self.raid_until = {}  # サーバーID -> レイドモード終了時刻
+        self.raid_joins = {}  # サーバーID -> レイドモード中の参加者数
+        self.queues = {}  # サーバーID -> まとめて処理する参加者のリスト
+
+    def in_raid(self, guild_id):
+        return guild_id in self.raid_until
+
+    def record_join(self, member, now):
+        # 参加を記録し、"started"（今レイドモードに入った）・"raid"（レイドモード中）・None を返す
+        guild_id = member.guild.id
+        count = self.joins.add(guild_id, now)
+        state = None
+        if guild_id in self.raid_until:
+            state = "raid"
+        elif count >= self.threshold:
+            state = "started"
+            self.raid_joins[guild_id] = 0
+            self.queues[guild_id] = []
+        if state:
+            self.raid_until[guild_id] = now + self.duration
+            self.raid_joins[guild_id] += 1
+            queue = self.queues[guild_id]
+            if len(queue) < self.max_queue:
+                queue.append(member)
+        return state
+
+    def take_queue(self, guild_id):
+        queue = self.queues.get(guild_id, [])
+        self.queues[guild_id] = []
+        return queue
+
+    def ended(self, now):
+        # レイドモードが終わったサーバーの (サーバーID, 参加者数) を返して片付ける
+        finished = []
+        for guild_id in [g for g, until in self.raid_until.items() if now >= until]:
+            finished.append((guild_id, self.raid_joins.pop(guild_id, 0)))
+            del self.raid_until[guild_id]
+            self.queues.pop(guild_id, None)
+        return finished
+
+class MentionTracker:
+    """ユーザー・ロール・@everyone へのメンション数をサーバーごとのスライディングウィンドウで数え、
+    1通あたりの上限と一定時間あたりの上限を判定する"""
+
+    def __init__(self):
+        self.guilds = {}  # サーバーID -> SlidingWindowCounter(ユーザーID -> メンション数)
+
+    @staticmethod
+    def count(message):
+        return len(message.mentions) + len(message.role_mentions) + (1 if message.mention_everyone else 0)
+
+    def check(self, message, now, guild_settings):
+        # 上限を超えたら "message"（1通で超過）か "window"（期間内の合計で超過）、超えなければ None
+        mentions = self.count(message)
+        if not mentions:
+            return None
+        guild_id = message.guild.id
+        limit = guild_settings.mention_window_limit
+        counter = self.guilds.get(guild_id)
+        if counter is None or counter.max_events != limit:
+            # 重みは1以上なので、最新 limit 件だけ覚えておけば超過を判定できる
+            counter = self.guilds[guild_id] = SlidingWindowCounter(window=guild_settings.mention_window_seconds, max_events=limit)
+        counter.window = guild_settings.mention_window_seconds
+        total = counter.add(message.author.id, now, weight=mentions)
+        if mentions >= guild_settings.mention_limit:
+            exceeded = "message"
+        elif total >= limit:
+            exceeded = "window"
+        else:
+            return None
+        counter.discard(message.author.id)  # タイムアウト後は数え直す
+        return exceeded
+
+    def forget(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def clear(self):
+        self.guilds.clear()
 
 # 不適切な単語リスト（設定可能）
-def get_bad_words():
-    return config.get("bad_words", ["spam", "アホ", "バカ", "死ね", "殺す"])
+DEFAULT_BAD_WORDS = ["spam", "アホ", "バカ", "死ね", "殺す"]
+
+class KeywordMatcher:
+    """複数のキーワードを Aho–Corasick 法でまとめて検索する（大文字小文字は区別しない）"""
+
+    def __init__(self, keywords):
+        self.transitions = [{}]  # ノード -> {文字: 次のノード}
+        self.fail = [0]  # 一致しなかった時に戻るノード
+        self.output = [None]  # このノードで一致するキーワード（元の表記）
+
+        for keyword in keywords:
+            if not keyword:
+                continue
+            node = 0
+            for ch in keyword.lower():
+                next_node = self.transitions[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.transitions)
+                    self.transitions[node][ch] = next_node
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                node = next_node
+            if self.output[node] is None:
+                self.output[node] = keyword
+
+        # 幅優先で失敗リンクを張り、途中で終わるキーワードも拾えるようにする
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.transitions[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.transitions[fallback].get(ch, 0)
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+    def search(self, text):
+        # 最初に見つかったキーワードを返す（なければ None）
+        transitions = self.transitions
+        fail = self.fail
+        output = self.output
+        node = 0
+        for ch in text.lower():
+            while node and ch not in transitions[node]:
+                node = fail[node]
+            node = transitions[node].get(ch, 0)
+            if output[node] is not None:
+                return output[node]
+        return None
+
+RAID_JOIN_ACTIONS = ("none", "kick", "timeout")
+LEVEL_STORAGE_BACKENDS = ("json", "sqlite")
+GRANTABLE_CAPABILITIES = ("administrator", "manage_messages", "bot_command")  # ロールに付与できる機能
+CAPABILITY_NAMES = {"administrator": "管理者コマンド", "manage_messages": "メッセージ管理コマンド", "bot_command": "Botコマンド（AI・翻訳など）"}
+
+def setting_bool(raw, key, default):
+    value = raw.get(key, default)
+    if isinstance(value, bool):
+        return value
+    print(f"設定 {key} の値が不正です（{value!r}）。既定値 {default!r} を使います")
+    return default
+
+def setting_number(raw, key, default, minimum=0, maximum=None):
+    value = raw.get(key, default)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value >= minimum and (maximum is None or value <= maximum):
+        return value
+    print(f"設定 {key} の値が不正です（{value!r}）。既定値 {default!r} を使います")
+    return default
+
+def setting_id(raw, key):
+    value = raw.get(key)
+    if value is None or (isinstance(value, int) and not isinstance(value, bool)):
+        return value
+    print(f"設定 {key} の値が不正です（{value!r}）。未設定として扱います")
+    return None
+
+def setting_rate_limits(raw):
+    # スコープ -> (容量, 秒数)。無効なスコープは None
+    policies = raw.get("rate_limits", DEFAULT_RATE_LIMITS)
+    if not isinstance(policies, dict):
+        print(f"設定 rate_limits の値が不正です（{policies!r}）。既定値を使います")
+        policies = DEFAULT_RATE_LIMITS
+    rate_limits = {}
+    for scope in RateLimiter.SCOPES:
+        policy = policies.get(scope)
+        if not policy:
+            rate_limits[scope] = None
+            continue
+        capacity = setting_number(policy, "capacity", 0)
+        per_seconds = setting_number(policy, "per_seconds", 10, minimum=1)
+        rate_limits[scope] = (capacity, per_seconds) if capacity > 0 else None
+    return rate_limits
+
+def setting_role_grants(raw):
+    # 機能 -> その機能を持つロールIDの集合
+    grants = raw.get("role_grants", {})
+    if not isinstance(grants, dict):
+        print(f"設定 role_grants の値が不正です（{grants!r}）。ロールへの付与はなしとして扱います")
+        return {}
+    return {
+        capability: frozenset(r for r in role_ids if isinstance(r, int))
+        for capability, role_ids in grants.items()
+        if capability in GRANTABLE_CAPABILITIES and isinstance(role_ids, list) and role_ids
+    }
 
-# 短時間での連続投稿をチェック
-def is_spam_message(user_id, current_time):
-    if user_id not in user_message_timestamps:
-        user_message_timestamps[user_id] = []
+AUTO_REPLY_MAX_COOLDOWN = 3600  # 自動返信のクールダウンの上限（秒）
+
+# 自動返信の既定値（config の auto_replies で置き換えられる）
+DEFAULT_AUTO_REPLIES = [
+    {
+        "name": "yuki",
+        "keywords": ["ゆき", "yuki", "雪"],
+        "title": "❄️ 雪について",
+        "description": "雪（ゆき/yuki）は、このbotの作成者であり、とても可愛い女の子です！💕",
+        "color": 0xADD8E6,  # 薄い青色（雪をイメージ）
+        "fields": [{"name": "特徴", "value": "・botの開発者\n・可愛い女の子\n・プログラミングが得意", "inline": False}],
+        "footer": "雪ちゃんに感謝！ ❄️",
+        "cooldown_seconds": 60
+    }
+]
+
+class AutoReply:
+    """自動返信の1件分。返信の embed は設定の読み込み時に一度だけ作り、送信のたびに使い回す"""
+
+    def __init__(self, source):
+        self.source = source  # 検証済みの設定（コマンドで書き換える時の元データ）
+        self.name = source["name"]
+        self.keywords = tuple(source["keywords"])
+        self.cooldown = source["cooldown_seconds"]
+        self.embed = discord.Embed(title=source["title"], description=source["description"], color=discord.Color(source["color"]))
+        for field in source["fields"]:
+            self.embed.add_field(name=field["name"], value=field["value"], inline=field.get("inline", False))
+        if source["footer"]:
+            self.embed.set_footer(text=source["footer"])
+
+def setting_color(raw, key, default):
+    # discord.Color は整数しか受け付けないので、小数などは既定値にする
+    value = raw.get(key, default)
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 0xFFFFFF:
+        return value
+    print(f"設定 {key} の値が不正です（{value!r}）。既定値 {default!r} を使います")
+    return default
+
+def setting_auto_replies(entries):
+    # 不正な項目は読み飛ばす
+    if not isinstance(entries, list):
+        print(f"設定 auto_replies の値が不正です（{entries!r}）。自動返信はなしとして扱います")
+        return ()
+    replies = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not isinstance(entry.get("keywords"), list):
+            print(f"設定 auto_replies の項目が不正です（{entry!r}）。読み飛ばします")
+            continue
+        fields = entry.get("fields", [])
+        source = {
+            "name": entry["name"],
+            "keywords": [k for k in entry["keywords"] if isinstance(k, str) and k],
+            "title": str(entry.get("title", "")),
+            "description": str(entry.get("description", "")),
+            "color": setting_color(entry, "color", 0xADD8E6),
+            "fields": [f for f in fields if isinstance(f, dict) and "name" in f and "value" in f] if isinstance(fields, list) else [],
+            "footer": str(entry.get("footer", "")),
+            "cooldown_seconds": setting_number(entry, "cooldown_seconds", 60, maximum=AUTO_REPLY_MAX_COOLDOWN)
+        }
+        if source["keywords"]:
+            replies.append(AutoReply(source))
+    return tuple(replies)
+
+def build_auto_replies(entries):
+    # (AutoReply の一覧, キーワード -> AutoReply, 検索器) を作る（重複したキーワードは先の項目を優先）
+    replies = setting_auto_replies(entries)
+    triggers = {}
+    for reply in replies:
+        for keyword in reply.keywords:
+            triggers.setdefault(keyword, reply)
+    return replies, triggers, KeywordMatcher(triggers)
+
+class BuildCache:
+    """作るのに時間のかかる値（単語の検索器など）を内容をキーに max_size 件まで LRU で使い回す。
+    設定を作り直しても内容が同じなら作り直さない"""
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def get(self, key, build):
+        value = self.items.get(key)
+        if value is None:
+            value = self.items[key] = build()
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        else:
+            self.items.move_to_end(key)
+        return value
+
+bad_word_matchers = BuildCache()  # 単語のタプル -> KeywordMatcher
+auto_reply_builds = BuildCache()  # 自動返信の設定（JSON文字列） -> build_auto_replies の結果
+
+class Settings:
+    """config.json の内容を検証して作る読み取り専用の設定。
+    よく使う派生値（単語の検索器・timedelta・許可ユーザーの集合）も作っておき、変更時はまるごと差し替える"""
+
+    def __init__(self, raw):
+        self.anti_spam_enabled = setting_bool(raw, "anti_spam_enabled", True)
+        self.level_system_enabled = setting_bool(raw, "level_system_enabled", True)
+        self.levelup_notifications = setting_bool(raw, "levelup_notifications", True)
+        self.welcome_dm_enabled = setting_bool(raw, "welcome_dm_enabled", True)
+
+        self.timeout_minutes = setting_number(raw, "timeout_minutes", 10, minimum=1, maximum=1440)
+        self.timeout_duration = datetime.timedelta(minutes=self.timeout_minutes)
+        self.min_account_age_days = setting_number(raw, "min_account_age_days", 7, maximum=365)
+        self.raid_min_account_age_days = setting_number(raw, "raid_min_account_age_days", 30)
+        self.raid_min_account_age = datetime.timedelta(days=self.raid_min_account_age_days)
+
+        self.log_channel_id = setting_id(raw, "log_channel_id")
+        self.bot_owner_id = setting_id(raw, "bot_owner_id")
+        allowed_users = raw.get("allowed_command_users", [])
+        self.allowed_command_users = frozenset(u for u in allowed_users if isinstance(u, int)) if isinstance(allowed_users, list) else frozenset()
+
+        bad_words = raw.get("bad_words", DEFAULT_BAD_WORDS)
+        self.bad_words = tuple(w for w in bad_words if isinstance(w, str)) if isinstance(bad_words, list) else tuple(DEFAULT_BAD_WORDS)
+        # 単語リストが同じなら（他のサーバーや以前の設定のものでも）検索器を使い回す
+        self.bad_word_matcher = bad_word_matchers.get(self.bad_words, lambda: KeywordMatcher(self.bad_words))
+
+        auto_replies = raw.get("auto_replies", DEFAULT_AUTO_REPLIES)
+        # 自動返信が同じなら embed と検索器を使い回す
+        auto_reply_key = json.dumps(auto_replies, sort_keys=True, ensure_ascii=False)
+        self.auto_replies, self.auto_reply_triggers, self.auto_reply_matcher = auto_reply_builds.get(
+            auto_reply_key, lambda: build_auto_replies(auto_replies)
+        )
+        self.auto_reply_channel_cooldown_seconds = setting_number(raw, "auto_reply_channel_cooldown_seconds", 30, maximum=AUTO_REPLY_MAX_COOLDOWN)
+
+        self.rate_limits = setting_rate_limits(raw)
+        self.role_grants = setting_role_grants(raw)
+
+        self.raid_join_action = raw.get("raid_join_action", "none")
+        if self.raid_join_action not in RAID_JOIN_ACTIONS:
+            print(f"設定 raid_join_action の値が不正です（{self.raid_join_action!r}）。既定値 'none' を使います")
+            self.raid_join_action = "none"
+        self.raid_join_threshold = setting_number(raw, "raid_join_threshold", 10, minimum=1)
+        self.raid_join_window_seconds = setting_number(raw, "raid_join_window_seconds", 10, minimum=1)
+        self.raid_mode_duration_seconds = setting_number(raw, "raid_mode_duration_seconds", 300, minimum=1)
+
+        self.mention_limit = setting_number(raw, "mention_limit", 2, minimum=1)
+        self.mention_window_limit = setting_number(raw, "mention_window_limit", 5, minimum=1)
+        self.mention_window_seconds = setting_number(raw, "mention_window_seconds", 60, minimum=1)
+
+        self.duplicate_threshold = setting_number(raw, "duplicate_threshold", 4, minimum=2)
+        self.duplicate_window_seconds = setting_number(raw, "duplicate_window_seconds", 30, minimum=1)
+        self.duplicate_min_length = setting_number(raw, "duplicate_min_length", 8)
+
+        self.warning_half_life_seconds = setting_number(raw, "warning_half_life_seconds", 86400, minimum=60)
+        self.xp_cooldown_seconds = setting_number(raw, "xp_cooldown_seconds", 60)
+        # XPカーブは起動時にだけ反映する（必要XPが1以上になるよう base は1以上）
+        self.xp_curve_base = setting_number(raw, "xp_curve_base", 100, minimum=1)
+        self.xp_curve_exponent = setting_number(raw, "xp_curve_exponent", 2, maximum=5)
+        self.xp_batch_interval_seconds = setting_number(raw, "xp_batch_interval_seconds", 10, minimum=1)
+
+        self.level_flush_interval_seconds = setting_number(raw, "level_flush_interval_seconds", 30, minimum=1)
+        self.level_flush_dirty_threshold = setting_number(raw, "level_flush_dirty_threshold", 100, minimum=1)
+        self.level_store_idle_seconds = setting_number(raw, "level_store_idle_seconds", 600, minimum=1)
+        # 保存方式とサーバー別設定のキャッシュ件数は起動時にだけ反映する
+        self.level_storage_backend = raw.get("level_storage_backend", "json")
+        if self.level_storage_backend not in LEVEL_STORAGE_BACKENDS:
+            print(f"設定 level_storage_backend の値が不正です（{self.level_storage_backend!r}）。既定値 'json' を使います")
+            self.level_storage_backend = "json"
+        self.guild_config_cache_size = setting_number(raw, "guild_config_cache_size", 256, minimum=1)
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError("Settings は変更できません（config を書き換えて refresh_settings を呼んでください）")
+        object.__setattr__(self, name, value)
+
+settings = Settings(config)
+xp_curve_base = settings.xp_curve_base
+xp_curve_exponent = settings.xp_curve_exponent
+level_storage_backend = settings.level_storage_backend
+level_stores.idle_timeout = settings.level_store_idle_seconds
+xp_aggregator.cooldown = settings.xp_cooldown_seconds
+xp_aggregator.batch_interval = settings.xp_batch_interval_seconds
+xp_commit_loop.change_interval(seconds=settings.xp_batch_interval_seconds)
+
+# 荒らし対策用の変数
+raid_detector = RaidDetector(
+    threshold=settings.raid_join_threshold,
+    window=settings.raid_join_window_seconds,
+    duration=settings.raid_mode_duration_seconds
+)
+rate_limiter = RateLimiter({scope: {"capacity": p[0], "per_seconds": p[1]} for scope, p in settings.rate_limits.items() if p})
+duplicate_detector = DuplicateMessageDetector(
+    threshold=settings.duplicate_threshold,
+    window=settings.duplicate_window_seconds,
+    min_length=settings.duplicate_min_length
+)
+
+WARNING_LEDGER_FILE = "warning_ledger.db"  # 警告スコアを保存するファイル
+
+class WarningLedger:
+    """サーバー・ユーザーごとの警告スコアを SQLite に保存する台帳。
+    スコアは half_life 秒で半分になるよう読み出し時に減衰させ、ユーザーごとに初回利用時に読み込み、変更はまとめて書き出す"""
+
+    def __init__(self, path: str, half_life: float = 86400, flush_interval: float = 30, dirty_threshold: int = 100, cache_ttl: float = 3600):
+        self.path = path
+        self.half_life = half_life  # スコアが半分になるまでの秒数
+        self.flush_interval = flush_interval  # 定期書き出しの間隔（秒）
+        self.dirty_threshold = dirty_threshold  # この件数の変更が溜まったら書き出し
+        self.conn = None
+        self.cache = TTLMap(ttl=cache_ttl)  # (サーバーID, ユーザーID) -> (スコア, 更新時刻)
+        self.pending = {}  # まだ書き出していない (サーバーID, ユーザーID) -> (スコア, 更新時刻)
+        self.last_flush = time.monotonic()
+
+    def open(self):
+        # 読み書きはスレッドプールで行う（同じファイルへのアクセスは FileIO が直列化する）
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS warnings ("
+            "guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, score REAL NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (guild_id, user_id)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def read(self, key):
+        self.open()
+        row = self.conn.execute("SELECT score, updated FROM warnings WHERE guild_id = ? AND user_id = ?", key).fetchone()
+        return (row[0], row[1]) if row else (0.0, 0.0)
+
+    def read_guild(self, guild_id):
+        self.open()
+        rows = self.conn.execute("SELECT user_id, score, updated FROM warnings WHERE guild_id = ?", (guild_id,))
+        return {(guild_id, user_id): (score, updated) for user_id, score, updated in rows}
+
+    def decayed(self, entry, now):
+        score, updated = entry
+        if not score:
+            return 0.0
+        return score * 0.5 ** (max(0.0, now - updated) / self.half_life)
+
+    async def load(self, key):
+        entry = self.pending.get(key) or self.cache.get(key)
+        if entry is not None:
+            return entry
+        entry = await file_io.run(self.path, self.read, key)
+        # 読み込み中に他のメッセージで更新されていればそちらを使う
+        current = self.pending.get(key) or self.cache.get(key)
+        if current is not None:
+            return current
+        self.cache[key] = entry
+        return entry
+
+    def store(self, key, entry):
+        self.pending[key] = entry
+        self.cache[key] = entry
+
+    async def score(self, guild_id, user_id):
+        return self.decayed(await self.load((guild_id, user_id)), time.time())
+
+    async def add(self, guild_id, user_id, amount=1.0):
+        # 警告を加え、減衰後の新しいスコアを返す
+        key = (guild_id, user_id)
+        now = time.time()
+        score = self.decayed(await self.load(key), now) + amount
+        self.store(key, (score, now))
+        return score
+
+    def reset(self, guild_id, user_id):
+        self.store((guild_id, user_id), (0.0, time.time()))
+
+    async def active_count(self, guild_id, minimum=0.5):
+        # スコアが minimum 以上残っているユーザー数
+        entries = await file_io.run(self.path, self.read_guild, guild_id)
+        entries.update((key, entry) for key, entry in self.pending.items() if key[0] == guild_id)
+        now = time.time()
+        return sum(1 for entry in entries.values() if self.decayed(entry, now) >= minimum)
+
+    def needs_flush(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.dirty_threshold or time.monotonic() - self.last_flush >= self.flush_interval
+
+    def write_batch(self, rows, cutoff):
+        self.open()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO warnings (guild_id, user_id, score, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(guild_id, user_id) DO UPDATE SET score = excluded.score, updated = excluded.updated",
+                rows
+            )
+            # 十分に減衰した（半減期の10倍以上更新のない）行は消す
+            self.conn.execute("DELETE FROM warnings WHERE score = 0 OR updated < ?", (cutoff,))
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch = dict(self.pending)
+        self.last_flush = time.monotonic()
+        rows = [(guild_id, user_id, score, updated) for (guild_id, user_id), (score, updated) in batch.items()]
+        try:
+            await file_io.run(self.path, self.write_batch, rows, time.time() - self.half_life * 10)
+        except (sqlite3.Error, OSError) as e:
+            print(f"警告台帳の書き出しエラー: {e}")
+            return
+        # 書き出し中に再度更新されたユーザーは次回まで残す
+        for key, entry in batch.items():
+            if self.pending.get(key) is entry:
+                del self.pending[key]
+
+    def close_connection(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self):
+        await self.flush()
+        await file_io.run(self.path, self.close_connection)
+
+    def clear(self):
+        self.cache.clear()
+        self.pending.clear()
+
+warning_ledger = WarningLedger(WARNING_LEDGER_FILE, half_life=settings.warning_half_life_seconds)
+mention_tracker = MentionTracker()
+
+# config の内容から設定を作り直して差し替え、動作中の検出器にも反映する
+def refresh_settings(new_settings=None):
+    global settings
+    old, settings = settings, new_settings or Settings(config)
+    for scope, policy in settings.rate_limits.items():
+        if policy != old.rate_limits[scope]:
+            rate_limiter.set_policy(scope, *(policy or (0, 1)))
+    if settings.raid_join_threshold != old.raid_join_threshold:
+        raid_detector.joins.clear()  # 記録の上限が変わるので数え直す
+    raid_detector.threshold = settings.raid_join_threshold
+    raid_detector.joins.window = settings.raid_join_window_seconds
+    raid_detector.joins.max_events = settings.raid_join_threshold
+    raid_detector.duration = settings.raid_mode_duration_seconds
+    duplicate_detector.threshold = settings.duplicate_threshold
+    duplicate_detector.window = settings.duplicate_window_seconds
+    duplicate_detector.min_length = settings.duplicate_min_length
+    warning_ledger.half_life = settings.warning_half_life_seconds
+    xp_aggregator.cooldown = settings.xp_cooldown_seconds
+    if settings.xp_batch_interval_seconds != old.xp_batch_interval_seconds:
+        xp_aggregator.batch_interval = settings.xp_batch_interval_seconds
+        xp_commit_loop.change_interval(seconds=settings.xp_batch_interval_seconds)
+    level_stores.idle_timeout = settings.level_store_idle_seconds
+
+# サーバーごとに上書きできる設定（それ以外は全サーバー共通）
+GUILD_SETTING_KEYS = frozenset({
+    "anti_spam_enabled", "level_system_enabled", "levelup_notifications", "welcome_dm_enabled",
+    "timeout_minutes", "min_account_age_days", "raid_min_account_age_days", "raid_join_action",
+    "log_channel_id", "bad_words", "role_grants",
+    "mention_limit", "mention_window_limit", "mention_window_seconds",
+    "auto_replies", "auto_reply_channel_cooldown_seconds"
+})
+GUILD_CONFIG_DIR = "guild_config"  # サーバーごとの設定を保存するディレクトリ
+
+class GuildConfigManager:
+    """サーバーごとの設定（config.json の値を上書きする分だけ）を初回利用時に読み込み、
+    最近使った max_size サーバー分だけ LRU でメモリに残す。上書きのないサーバーは共通の設定をそのまま使う"""
+
+    def __init__(self, directory: str, max_size: int = 256):
+        self.directory = directory
+        self.max_size = max_size
+        self.stores = collections.OrderedDict()  # サーバーID -> 読み込みタスク（結果は ConfigStore）
+        self.resolved = {}  # サーバーID -> (元にした共通設定, 上書きを反映した設定)
+        self.closing = {}  # サーバーID -> 追い出し時の書き出しタスク
+
+    def path(self, guild_id):
+        return os.path.join(self.directory, f"{guild_id}.json")
+
+    async def load(self, guild_id):
+        closing = self.closing.get(guild_id)
+        if closing is not None:
+            # 追い出したばかりのサーバーは書き出しが終わってから読み直す
+            await closing
+        path = self.path(guild_id)
+        try:
+            data = await file_io.run(path, load_json_file, path)
+        except (OSError, ValueError) as e:
+            print(f"サーバー設定の読み込みエラー ({guild_id})（共通の設定を使います）: {e}")
+            data = {}
+        return ConfigStore(
+            path, data,
+            build=self.resolve,
+            apply=lambda resolved: self.cache_resolved(guild_id, resolved),
+            history_size=5
+        )
 
-    # 過去10秒以内のメッセージを取得
-    recent_messages = [t for t in user_message_timestamps[user_id] if current_time - t < 10]
-    user_message_timestamps[user_id] = recent_messages + [current_time]
+    def cache_resolved(self, guild_id, resolved):
+        # 追い出されたサーバー（読み込み中に追い出された場合を含む）の設定は覚えない
+        if guild_id in self.stores:
+            self.resolved[guild_id] = (settings, resolved)
+
+    def resolve(self, data):
+        # 上書き分を共通の設定に重ねた設定を作る（上書きがなければ共通の設定そのもの）
+        overrides = {k: v for k, v in data.items() if k in GUILD_SETTING_KEYS}
+        return Settings({**config, **overrides}) if overrides else settings
+
+    async def open(self, guild_id):
+        task = self.stores.get(guild_id)
+        if task is None:
+            # 同時に開かれても読み込みは一度だけ
+            task = self.stores[guild_id] = asyncio.ensure_future(self.load(guild_id))
+            self.evict()
+        else:
+            self.stores.move_to_end(guild_id)
+        return await task
+
+    async def get(self, guild_id):
+        # サーバーで有効な設定を返す（サーバー外なら共通の設定）
+        if guild_id is None:
+            return settings
+        entry = self.resolved.get(guild_id)
+        if entry is not None and entry[0] is settings and guild_id in self.stores:
+            self.stores.move_to_end(guild_id)
+            return entry[1]
+        store = await self.open(guild_id)
+        resolved = self.resolve(store.data)
+        self.cache_resolved(guild_id, resolved)
+        return resolved
+
+    async def update(self, guild_id, reason, **changes):
+        store = await self.open(guild_id)
+        return store.update(reason, **changes)
+
+    def evict(self):
+        while len(self.stores) > self.max_size:
+            guild_id, task = self.stores.popitem(last=False)
+            self.resolved.pop(guild_id, None)
+            if task.done() and not task.cancelled() and task.exception() is None and task.result().dirty:
+                closing = self.closing[guild_id] = asyncio.ensure_future(task.result().close())
+                closing.add_done_callback(lambda _, g=guild_id: self.closing.pop(g, None))
+
+    async def close(self):
+        for task in list(self.stores.values()):
+            if task.done() and not task.cancelled() and task.exception() is None:
+                await task.result().close()
+        if self.closing:
+            await asyncio.gather(*self.closing.values())
+
+guild_configs = GuildConfigManager(GUILD_CONFIG_DIR, max_size=settings.guild_config_cache_size)
+
+CAPABILITY_ERRORS = {
+    "administrator": "エラー: このコマンドを使用するには管理者権限が必要です。",
+    "manage_messages": "エラー: このコマンドを使用するにはメッセージ管理権限が必要です。",
+    "bot_command": "❌ このコマンドを使用する権限がありません。",
+    "bot_owner": "❌ このコマンドはBot所有者のみ使用できます。"
+}
+
+class PermissionResolver:
+    """ユーザーが持つ機能（Discordの権限・ロールへの付与・許可ユーザー・Bot所有者）を解決する。
+    設定から決まる部分だけを (ユーザーID, ロールIDの集合) ごとにキャッシュし、
+    Discordの権限はインタラクションに含まれる最新の値を毎回使う"""
+
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl  # 使われなくなったキャッシュを捨てるまでの秒数
+        self.cache = {}  # サーバーID -> (元にした設定, TTLMap((ユーザーID, ロールIDの集合) -> 機能の集合))
+
+    def resolve_granted(self, user_id, role_ids, guild_settings):
+        # 設定（Bot所有者・許可ユーザー・ロールへの付与）から決まる機能
+        capabilities = set()
+        if settings.bot_owner_id and user_id == settings.bot_owner_id:
+            capabilities.update(("bot_owner", "bot_command"))
+        if user_id in settings.allowed_command_users:
+            capabilities.add("bot_command")
+        for capability, granted_roles in guild_settings.role_grants.items():
+            if not role_ids.isdisjoint(granted_roles):
+                capabilities.add(capability)
+        return frozenset(capabilities)
+
+    async def capabilities(self, user, guild):
+        guild_id = guild.id if guild else None
+        guild_settings = await guild_configs.get(guild_id)
+        entry = self.cache.get(guild_id)
+        if entry is None or entry[0] is not guild_settings:
+            # 設定（許可ユーザー・ロールへの付与）が変わったらサーバー分まとめて解決し直す
+            entry = self.cache[guild_id] = (guild_settings, TTLMap(ttl=self.ttl))
+        # ロールが変われば別のキーになるので、更新イベントを待たずに反映される
+        role_ids = frozenset(role.id for role in getattr(user, "roles", ()))
+        key = (user.id, role_ids)
+        granted = entry[1].get(key)
+        if granted is None:
+            granted = entry[1][key] = self.resolve_granted(user.id, role_ids, guild_settings)
+
+        guild_permissions = getattr(user, "guild_permissions", None)  # サーバー外（DM）では持っていない
+        if guild_permissions is None or not (guild_permissions.administrator or guild_permissions.manage_messages):
+            return granted
+        capabilities = set(granted)
+        if guild_permissions.administrator:
+            capabilities.add("administrator")
+        if guild_permissions.manage_messages:
+            capabilities.add("manage_messages")
+        return frozenset(capabilities)
+
+    def invalidate_guild(self, guild_id):
+        self.cache.pop(guild_id, None)
+
+permissions = PermissionResolver()
+
+def requires(*capabilities):
+    """コマンドに必要な機能を宣言するデコレータ（足りなければエラーを返して実行しない）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            granted = await permissions.capabilities(interaction.user, interaction.guild)
+            for capability in capabilities:
+                if capability not in granted:
+                    await interaction.response.send_message(CAPABILITY_ERRORS[capability], ephemeral=True)
+                    return
+            return await func(interaction, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# config.json が外部で編集されたら読み直して反映する
+@tasks.loop(seconds=5)
+async def config_reload_loop():
+    # 例外でループが止まると以後の外部編集が反映されなくなるので、記録して続ける
+    try:
+        await config_store.reload_if_changed()
+    except Exception as e:
+        print(f"設定の再読み込みエラー: {e}")
 
-    # 10秒以内に5回以上メッセージを送信した場合はスパム
-    return len(recent_messages) >= 4
+@tasks.loop(seconds=5)
+async def warning_flush_loop():
+    try:
+        if warning_ledger.needs_flush():
+            await warning_ledger.flush()
+    except Exception as e:
+        print(f"警告履歴の書き出しエラー: {e}")
 
 # 不適切な単語をチェック
-def contains_bad_words(message_content):
-    bad_words = get_bad_words()
-    message_lower = message_content.lower()
-    for word in bad_words:
-        if word.lower() in message_lower:
-            return True, word
-    return False, None
+def contains_bad_words(message_content, guild_settings=None):
+    word = (guild_settings or settings).bad_word_matcher.search(message_content)
+    return word is not None, word
 
 @bot.event
 async def on_ready(): 
@@ -216,74 +2056,181 @@ async def on_ready():
     bot.add_view(CloseTicketView())
     bot.add_view(ConfirmCloseView())
 
+    # 分割前のレベルデータを引き継ぐサーバーを記録（初回のみ）
+    await file_io.run(LEGACY_MIGRATION_FILE, record_legacy_migration_guilds, [g.id for g in bot.guilds])
+
+    # レベルデータの定期書き出しを開始（各サーバーのデータは初回利用時に読み込む）
+    if not level_flush_loop.is_running():
+        level_flush_loop.start()
+    if not xp_commit_loop.is_running():
+        xp_commit_loop.start()
+    if not raid_monitor_loop.is_running():
+        raid_monitor_loop.start()
+    if not config_reload_loop.is_running():
+        config_reload_loop.start()
+    if not warning_flush_loop.is_running():
+        warning_flush_loop.start()
+
     try:
         synced = await tree.sync()
         print(f"Synced {len(synced)} commands")
     except Exception as e:
         print(f"Error syncing commands: {e}")
 
+def get_log_channel(guild, guild_settings):
+    # 共通設定の log_channel_id は全サーバーの既定値になるので、別のサーバーのチャンネルには送らない
+    log_channel = bot.get_channel(guild_settings.log_channel_id) if guild_settings.log_channel_id else None
+    if log_channel is None or getattr(log_channel, "guild", None) is None or log_channel.guild.id != guild.id:
+        return None
+    return log_channel
+
 @bot.event
 async def on_member_join(member):
+    guild_settings = await guild_configs.get(member.guild.id)
+
+    # 再参加したメンバーのXPを順位インデックスに戻す
+    store = level_stores.stores.get(member.guild.id)
+    if store and store.rank_index is not None and not member.bot:
+        user_data = await store.get_async(member.id)
+        total_xp = calculate_total_xp(user_data["level"], user_data["xp"])
+        if total_xp > 0:
+            store.rank_index.update(member.id, total_xp)
+
+    # 参加ペースを記録し、レイドモード中は個別のログ・DMを送らずにまとめて処理する
+    raid_state = raid_detector.record_join(member, time.monotonic())
+    if raid_state == "started":
+        await send_raid_log(
+            member.guild,
+            "🚨 レイドモード開始",
+            f"短時間に {raid_detector.threshold} 人以上が参加したため、レイドモードに入りました。\n"
+            f"個別の入室ログとウェルカムDMを停止し、新規アカウント制限を "
+            f"{guild_settings.raid_min_account_age_days} 日に引き上げます。"
+        )
+    if raid_state:
+        return
+
     # ログチャンネルへの入室ログ送信
-    log_channel_id = config.get("log_channel_id")
-    if log_channel_id:
-        log_channel = bot.get_channel(log_channel_id)
-        if log_channel:
-            embed = discord.Embed(
-                title="🟢 メンバー参加",
-                description=f"{member.mention} がサーバーに参加しました",
-                color=discord.Color.green(),
-                timestamp=discord.utils.utcnow()
-            )
-            embed.add_field(name="ユーザー名", value=member.name, inline=True)
-            embed.add_field(name="ユーザーID", value=member.id, inline=True)
-            embed.add_field(name="アカウント作成日", value=member.created_at.strftime("%Y/%m/%d %H:%M:%S"), inline=False)
-            embed.set_thumbnail(url=member.display_avatar.url)
-            embed.set_footer(text=f"総メンバー数: {member.guild.member_count}")
+    log_channel = get_log_channel(member.guild, guild_settings)
+    if log_channel:
+        embed = discord.Embed(
+            title="🟢 メンバー参加",
+            description=f"{member.mention} がサーバーに参加しました",
+            color=discord.Color.green(),
+            timestamp=discord.utils.utcnow()
+        )
+        embed.add_field(name="ユーザー名", value=member.name, inline=True)
+        embed.add_field(name="ユーザーID", value=member.id, inline=True)
+        embed.add_field(name="アカウント作成日", value=member.created_at.strftime("%Y/%m/%d %H:%M:%S"), inline=False)
+        embed.set_thumbnail(url=member.display_avatar.url)
+        embed.set_footer(text=f"総メンバー数: {member.guild.member_count}")
 
-            await log_channel.send(embed=embed)
+        outbound.post(PRIORITY_LOG, ("send", log_channel.id), log_channel.send, embed=embed)
 
     # DMでウェルカムメッセージを送信（設定で有効になっている場合のみ）
-    welcome_dm_enabled = config.get("welcome_dm_enabled", True)  # デフォルトで有効
-    if welcome_dm_enabled:
-        try:
-            welcome_embed = discord.Embed(
-                title="🎉 ようこそ！",
-                description=f"**{member.guild.name}** へようこそ、{member.name}さん！",
-                color=discord.Color.gold(),
-                timestamp=discord.utils.utcnow()
-            )
-            welcome_embed.add_field(
-                name="サーバー情報",
-                value=f"サーバー名: {member.guild.name}\n"
-                      f"総メンバー数: {member.guild.member_count}人",
-                inline=False
-            )
-            welcome_embed.add_field(
-                name="お願い",
-                value="・サーバールールをお読みください\n"
-                      "・認証が必要な場合は認証チャンネルで認証してください\n"
-                      "・何かご不明な点がございましたらスタッフまでお声がけください",
-                inline=False
-            )
-            welcome_embed.set_thumbnail(url=member.guild.icon.url if member.guild.icon else None)
-            welcome_embed.set_footer(text=f"参加日時: {discord.utils.utcnow().strftime('%Y年%m月%d日 %H:%M:%S')}")
+    if guild_settings.welcome_dm_enabled:
+        welcome_embed = discord.Embed(
+            title="🎉 ようこそ！",
+            description=f"**{member.guild.name}** へようこそ、{member.name}さん！",
+            color=discord.Color.gold(),
+            timestamp=discord.utils.utcnow()
+        )
+        welcome_embed.add_field(
+            name="サーバー情報",
+            value=f"サーバー名: {member.guild.name}\n"
+                  f"総メンバー数: {member.guild.member_count}人",
+            inline=False
+        )
+        welcome_embed.add_field(
+            name="お願い",
+            value="・サーバールールをお読みください\n"
+                  "・認証が必要な場合は認証チャンネルで認証してください\n"
+                  "・何かご不明な点がございましたらスタッフまでお声がけください",
+            inline=False
+        )
+        welcome_embed.set_thumbnail(url=member.guild.icon.url if member.guild.icon else None)
+        welcome_embed.set_footer(text=f"参加日時: {discord.utils.utcnow().strftime('%Y年%m月%d日 %H:%M:%S')}")
 
-            await member.send(embed=welcome_embed)
-            print(f"ウェルカムメッセージを {member.name} に送信しました")
+        outbound.post(PRIORITY_COSMETIC, ("dm", member.id), send_welcome_dm, member, welcome_embed)
 
-        except discord.Forbidden:
-            print(f"ウェルカムメッセージの送信に失敗しました: {member.name} のDMが無効です")
-        except Exception as e:
-            print(f"ウェルカムメッセージ送信エラー: {e}")
+async def send_welcome_dm(member, embed):
+    try:
+        await member.send(embed=embed)
+        print(f"ウェルカムメッセージを {member.name} に送信しました")
+    except discord.Forbidden:
+        print(f"ウェルカムメッセージの送信に失敗しました: {member.name} のDMが無効です")
+    except Exception as e:
+        print(f"ウェルカムメッセージ送信エラー: {e}")
+
+async def send_raid_log(guild, title, description):
+    log_channel = get_log_channel(guild, await guild_configs.get(guild.id))
+    if not log_channel:
+        return
+    embed = discord.Embed(
+        title=title,
+        description=description,
+        color=discord.Color.red(),
+        timestamp=discord.utils.utcnow()
+    )
+    embed.set_footer(text=f"サーバー: {guild.name}")
+    outbound.post(
+        PRIORITY_LOG, ("send", log_channel.id), log_channel.send, embed=embed,
+        on_error=lambda e: print(f"レイドログの送信エラー: {e}")
+    )
+
+raid_action_failures = collections.Counter()  # サーバーID -> レイド対策の処理に失敗した人数
+
+def apply_raid_action(member, action):
+    # レイドモード中に参加した新規アカウントへの一括処理（"kick" または "timeout"）。結果は待たずに予約する
+    route = ("member", member.guild.id)
+
+    def on_error(e):
+        raid_action_failures[member.guild.id] += 1
+        print(f"レイド対策の処理エラー ({member.name}): {e}")
+
+    if action == "kick":
+        outbound.post(PRIORITY_MODERATION, route, member.kick, reason="レイド対策: 新規アカウントの一括キック", on_error=on_error)
+    elif action == "timeout":
+        outbound.post(PRIORITY_MODERATION, route, member.timeout, datetime.timedelta(hours=1), reason="レイド対策: 新規アカウントの一括タイムアウト", on_error=on_error)
+
+# レイドモード中の参加者をまとめて処理し、終了したらまとめてログを送る
+@tasks.loop(seconds=5)
+async def raid_monitor_loop():
+    # 例外でループが止まるとレイドモードが終わらなくなるので、記録して続ける
+    try:
+        now = discord.utils.utcnow()
+        for guild_id in list(raid_detector.raid_until):
+            members = raid_detector.take_queue(guild_id)
+            guild_settings = await guild_configs.get(guild_id)
+            action = guild_settings.raid_join_action
+            if members and action in ("kick", "timeout"):
+                targets = [m for m in members if now - m.created_at < guild_settings.raid_min_account_age]
+                for member in targets:
+                    apply_raid_action(member, action)
+
+        for guild_id, join_count in raid_detector.ended(time.monotonic()):
+            failures = raid_action_failures.pop(guild_id, 0)
+            guild = bot.get_guild(guild_id)
+            if guild:
+                description = f"レイドモード中に {join_count} 人が参加しました。通常のモードに戻ります。"
+                if failures:
+                    description += f"\n⚠️ {failures} 人への処理に失敗しました。"
+                await send_raid_log(guild, "🟢 レイドモード終了", description)
+    except Exception as e:
+        print(f"レイド監視の定期処理エラー: {e}")
+
+@bot.event
+async def on_guild_remove(guild):
+    permissions.invalidate_guild(guild.id)
+    mention_tracker.forget(guild.id)
 
 @bot.event
 async def on_member_remove(member):
-    log_channel_id = config.get("log_channel_id")
-    if not log_channel_id:
-        return
+    # 退出したメンバーを順位インデックスから外す
+    store = level_stores.stores.get(member.guild.id)
+    if store and store.rank_index is not None:
+        store.rank_index.remove(member.id)
 
-    log_channel = bot.get_channel(log_channel_id)
+    log_channel = get_log_channel(member.guild, await guild_configs.get(member.guild.id))
     if not log_channel:
         return
 
@@ -300,178 +2247,521 @@ async def on_member_remove(member):
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.set_footer(text=f"総メンバー数: {member.guild.member_count}")
 
-    await log_channel.send(embed=embed)
-
-@bot.event
-async def on_message(message):
-    if message.author.bot:
-        return
-
-    current_time = datetime.datetime.now().timestamp()
-    user_id = message.author.id
-
-    # 荒らし対策機能が有効かチェック
-    anti_spam_enabled = config.get("anti_spam_enabled", True)
-    if not anti_spam_enabled:
-        # レベルシステムが有効かチェック
-        level_system_enabled = config.get("level_system_enabled", True)
-        if level_system_enabled and not message.author.bot:
-            # メッセージ送信でXPを獲得（ランダムで15-25XP）
-            xp_gain = random.randint(15, 25)
-            leveled_up, new_level = add_xp(message.author.id, xp_gain)
-
-            if leveled_up:
-                # レベルアップ通知が有効な場合のみ送信
-                levelup_notifications = config.get("levelup_notifications", True)
-                if levelup_notifications:
-                    embed = discord.Embed(
-                        title="🎉 レベルアップ！",
-                        description=f"{message.author.mention} がレベル **{new_level}** に到達しました！",
-                        color=discord.Color.gold()
-                    )
-                    embed.set_thumbnail(url=message.author.display_avatar.url)
-                    await message.channel.send(embed=embed)
-
-        await bot.process_commands(message)
-        return
-
-    # 新規アカウント制限チェック
-    account_age_days = (datetime.datetime.now() - message.author.created_at.replace(tzinfo=None)).days
-    min_account_age = config.get("min_account_age_days", 7)
-    if account_age_days < min_account_age:
-        try:
-            await message.delete()
-            embed = discord.Embed(
-                title="🚫 新規アカウント制限",
-                description=f"{message.author.mention} アカウント作成から{min_account_age}日経過していないため、メッセージが削除されました。",
-                color=discord.Color.red()
-            )
-            warning_msg = await message.channel.send(embed=embed)
-            await warning_msg.delete(delay=10)
+    outbound.post(PRIORITY_LOG, ("send", log_channel.id), log_channel.send, embed=embed)
+
+# 送信処理の優先度（小さいほど先に処理する）
+PRIORITY_MODERATION = 0  # メッセージ削除・タイムアウト・キック
+PRIORITY_LOG = 1  # ログ・警告の送信
+PRIORITY_COSMETIC = 2  # レベルアップ通知・自動反応・ウェルカムDM（混雑時は捨てる）
+PRIORITY_NAMES = {PRIORITY_MODERATION: "moderation", PRIORITY_LOG: "log", PRIORITY_COSMETIC: "cosmetic"}
+
+# ルートの種類 -> (容量, 秒数)。DiscordのAPI制限に合わせて自前で送信ペースを抑える
+OUTBOUND_ROUTE_LIMITS = {
+    "send": (5, 5),  # チャンネルへの送信
+    "edit": (5, 5),  # チャンネル内のメッセージ編集
+    "delete": (5, 1),  # チャンネル内のメッセージ削除
+    "bulk_delete": (1, 1),  # チャンネル内のメッセージ一括削除
+    "member": (10, 10),  # サーバーのメンバーへのタイムアウト・キック
+    "dm": (5, 5)  # ユーザーへのDM
+}
+
+class OutboundJob:
+    __slots__ = ("route", "func", "args", "kwargs", "merge_key", "future", "on_error", "created", "reserved")
+
+    def __init__(self, route, func, args, kwargs, merge_key, future, on_error):
+        self.route = route
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        self.future = future
+        self.on_error = on_error
+        self.created = time.monotonic()
+        self.reserved = False  # ルートのトークンを確保済みか
+
+class OutboundScheduler:
+    """Discord への送信・削除・タイムアウトなどを優先度順に処理する。
+    ルート（チャンネルやサーバー）ごとのトークンバケットで送信ペースを抑え、混雑時は優先度の低い処理を捨てるかまとめる。
+    トークンが足りないルートの処理はルートごとの待ち行列に入れ、トークンが戻るたびに1件ずつ戻す"""
+
+    def __init__(self, workers: int = 4, pressure_threshold: int = 100, max_cosmetic_delay: float = 10):
+        self.workers = workers  # 同時に実行する数
+        self.pressure_threshold = pressure_threshold  # 待ち件数がこれを超えたら優先度の低い処理を受け付けない
+        self.max_cosmetic_delay = max_cosmetic_delay  # 優先度の低い処理を待たせる最長の秒数
+        self.queue = None  # (優先度, 通し番号, OutboundJob)
+        self.parked = 0  # ルートの空き待ちで一時的にキューから外している件数
+        self.waiting = {}  # ルート -> 空き待ちの (優先度, 通し番号, OutboundJob) のヒープ
+        self.tasks = []
+        self.seq = 0
+        self.buckets = {}  # ルートの種類 -> TTLMap(ルート -> TokenBucket)
+        self.merging = {}  # まとめるキー -> 待っている OutboundJob
+        self.stats = {name: {"submitted": 0, "done": 0, "dropped": 0, "merged": 0} for name in PRIORITY_NAMES.values()}
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+
+    def submit(self, priority, route, func, *args, merge_key=None, on_error=None, future=None, **kwargs):
+        self.start()
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        stats["submitted"] += 1
+        if merge_key is not None:
+            pending = self.merging.get(merge_key)
+            if pending is not None:
+                # 同じキーの処理が待っていれば新しい内容で置き換える
+                pending.func, pending.args, pending.kwargs = func, args, kwargs
+                stats["merged"] += 1
+                return
+        if priority == PRIORITY_COSMETIC and self.pending() > self.pressure_threshold:
+            stats["dropped"] += 1
             return
-        except discord.Forbidden:
-            pass
+        job = OutboundJob(route, func, args, kwargs, merge_key, future, on_error)
+        if merge_key is not None:
+            self.merging[merge_key] = job
+        self.seq += 1
+        self.queue.put_nowait((priority, self.seq, job))
+
+    def post(self, priority, route, func, *args, **kwargs):
+        # 結果を待たずに送信を予約する（失敗はログに出すか on_error に渡す）
+        self.submit(priority, route, func, *args, **kwargs)
+
+    async def run(self, priority, route, func, *args, **kwargs):
+        # 送信を予約して結果を待つ（失敗した場合は例外をそのまま投げる）
+        future = asyncio.get_running_loop().create_future()
+        self.submit(priority, route, func, *args, future=future, **kwargs)
+        return await future
+
+    def post_later(self, delay, priority, route, func, *args, **kwargs):
+        asyncio.get_running_loop().call_later(delay, lambda: self.post(priority, route, func, *args, **kwargs))
+
+    def reserve(self, route, now):
+        # ルートのトークンを1つ使う。足りなければ使えるまでの秒数を返す
+        capacity, per_seconds = OUTBOUND_ROUTE_LIMITS[route[0]]
+        buckets = self.buckets.get(route[0])
+        if buckets is None:
+            buckets = self.buckets[route[0]] = TTLMap(ttl=per_seconds)
+        bucket = buckets.get(route)
+        if bucket is None:
+            bucket = TokenBucket(capacity, now)
+        else:
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * capacity / per_seconds)
+            bucket.updated = now
+        buckets[route] = bucket
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0
+        return (1 - bucket.tokens) * per_seconds / capacity
+
+    def token_interval(self, route):
+        capacity, per_seconds = OUTBOUND_ROUTE_LIMITS[route[0]]
+        return per_seconds / capacity
+
+    def park(self, item, wait):
+        # ルートの待ち行列に入れる。待ち行列が新しければ、トークンが戻る頃に release を予約する
+        priority, _, job = item
+        heap = self.waiting.get(job.route)
+        if heap is None:
+            heap = self.waiting[job.route] = []
+            asyncio.get_running_loop().call_later(wait, self.release, job.route)
+        else:
+            wait = (len(heap) + 1) * self.token_interval(job.route)
+        if priority == PRIORITY_COSMETIC and time.monotonic() + wait - job.created > self.max_cosmetic_delay:
+            self.drop(priority, job)
+            return
+        heapq.heappush(heap, item)
+        self.parked += 1
+
+    def release(self, route):
+        # 待ち行列から優先度の高い順に1件だけトークンを確保してキューに戻し、次の release を予約する
+        heap = self.waiting[route]
+        now = time.monotonic()
+        while heap and heap[0][0] == PRIORITY_COSMETIC and now - heap[0][2].created > self.max_cosmetic_delay:
+            priority, _, job = heapq.heappop(heap)
+            self.parked -= 1
+            self.drop(priority, job)
+        if not heap:
+            del self.waiting[route]
+            return
+        wait = self.reserve(route, now)
+        if wait == 0:
+            item = heapq.heappop(heap)
+            self.parked -= 1
+            item[2].reserved = True
+            self.queue.put_nowait(item)
+            if not heap:
+                del self.waiting[route]
+                return
+            wait = self.token_interval(route)
+        asyncio.get_running_loop().call_later(wait, self.release, route)
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, _, job = item
+            if not job.reserved:
+                if job.route in self.waiting:
+                    # 既に空き待ちのルートは順番を守って後ろに並ぶ
+                    self.park(item, 0)
+                    continue
+                wait = self.reserve(job.route, time.monotonic())
+                if wait > 0:
+                    # 他のルートの処理を止めないよう、ルートの待ち行列に移す
+                    self.park(item, wait)
+                    continue
+            if job.merge_key is not None:
+                self.merging.pop(job.merge_key, None)
+            try:
+                result = await job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                if job.future is not None and not job.future.done():
+                    job.future.set_exception(e)
+                elif job.on_error is not None:
+                    job.on_error(e)
+                else:
+                    print(f"送信エラー ({job.route[0]}): {e}")
+            else:
+                if job.future is not None and not job.future.done():
+                    job.future.set_result(result)
+            self.stats[PRIORITY_NAMES[priority]]["done"] += 1
+
+    def drop(self, priority, job):
+        if job.merge_key is not None:
+            self.merging.pop(job.merge_key, None)
+        if job.future is not None and not job.future.done():
+            job.future.cancel()
+        self.stats[PRIORITY_NAMES[priority]]["dropped"] += 1
+
+    def pending(self):
+        return (self.queue.qsize() if self.queue is not None else 0) + self.parked
+
+outbound = OutboundScheduler()
+
+BULK_DELETE_MAX = 100  # 一括削除できる最大件数
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14, minutes=-5)  # 一括削除できるのは14日以内のメッセージ（少し余裕を持たせる）
+
+class BulkDeleteQueue:
+    """削除するメッセージをチャンネルごとに window 秒集め、channel.delete_messages でまとめて削除する。
+    一括削除できない14日より古いメッセージや1件だけの場合は1件ずつ削除する"""
+
+    def __init__(self, window: float = 1):
+        self.window = window  # 集める期間（秒）
+        self.pending = {}  # チャンネルID -> (チャンネル, {メッセージID: メッセージ})
+
+    def add(self, message):
+        entry = self.pending.get(message.channel.id)
+        if entry is None:
+            entry = self.pending[message.channel.id] = (message.channel, {})
+            asyncio.get_running_loop().call_later(self.window, self.flush, message.channel.id)
+        entry[1][message.id] = message
+
+    def flush(self, channel_id):
+        entry = self.pending.pop(channel_id, None)
+        if entry is None:
+            return
+        channel, messages = entry
+        self.delete(channel, list(messages.values()))
+
+    def delete(self, channel, messages, priority=PRIORITY_MODERATION):
+        # 削除を予約し、予約した API 呼び出しの数を返す
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        recent = [m for m in messages if m.created_at > cutoff]
+        singles = [m for m in messages if m.created_at <= cutoff]
+        calls = 0
+        for i in range(0, len(recent), BULK_DELETE_MAX):
+            chunk = recent[i:i + BULK_DELETE_MAX]
+            if len(chunk) == 1:
+                singles.extend(chunk)
+                continue
+            outbound.post(priority, ("bulk_delete", channel.id), channel.delete_messages, chunk)
+            calls += 1
+        for message in singles:
+            outbound.post(priority, ("delete", channel.id), message.delete)
+            calls += 1
+        return calls
+
+    def clear(self):
+        self.pending.clear()
+
+bulk_deletes = BulkDeleteQueue()
+
+class ChannelWarning:
+    def __init__(self):
+        self.lines = {}  # 警告の行 -> 件数（追加順）
+        self.message = None  # 送信済みの警告メッセージ
+        self.dirty = False  # 最後の送信・編集の後に追加された行があるか
+        self.task = None
+
+class ChannelWarningAggregator:
+    """モデレーションの警告をチャンネルごとにまとめる。window 秒の間の警告は1つの埋め込みに追記し、
+    edit_interval 秒ごとにまとめて編集するので、API呼び出しの数は違反の数ではなくチャンネルの数に比例する"""
+
+    def __init__(self, window: float = 15, edit_interval: float = 2, delete_after: float = 15, max_lines: int = 20):
+        self.window = window  # 1つの埋め込みにまとめる期間（秒）
+        self.edit_interval = edit_interval  # 埋め込みを編集する最短間隔（秒）
+        self.delete_after = delete_after  # まとめ終わってから警告を消すまでの秒数
+        self.max_lines = max_lines  # 埋め込みに載せる最大行数
+        self.channels = TTLMap(ttl=window)  # チャンネルID -> ChannelWarning
+
+    def warn(self, channel, line):
+        # 警告を追加する（送信・編集は裏で行う）
+        state = self.channels.get(channel.id)
+        if state is None:
+            state = ChannelWarning()
+            self.channels[channel.id] = state
+        state.lines[line] = state.lines.get(line, 0) + 1
+        state.dirty = True
+        if state.task is None:
+            state.task = asyncio.ensure_future(self.flush(channel, state))
+
+    def build(self, state):
+        lines = [f"{line} ×{count}" if count > 1 else line for line, count in state.lines.items()]
+        if len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + [f"…他 {len(lines) - self.max_lines} 件"]
+        return discord.Embed(
+            title="🛡️ 荒らし対策",
+            description="\n".join(lines),
+            color=discord.Color.red()
+        )
 
-    # 不適切な単語チェック
-    contains_bad, bad_word = contains_bad_words(message.content)
-    if contains_bad:
+    async def flush(self, channel, state):
+        # 最初の警告はすぐ送り、その後に追加された分は edit_interval ごとにまとめて編集する
         try:
-            await message.delete()
+            while state.dirty:
+                state.dirty = False
+                if state.message is None:
+                    state.message = await outbound.run(PRIORITY_LOG, ("send", channel.id), channel.send, embed=self.build(state))
+                    outbound.post_later(self.window + self.delete_after, PRIORITY_LOG, ("delete", channel.id), state.message.delete)
+                else:
+                    await outbound.run(PRIORITY_LOG, ("edit", channel.id), state.message.edit, embed=self.build(state))
+                await asyncio.sleep(self.edit_interval)
+        except discord.HTTPException as e:
+            print(f"警告メッセージの送信エラー: {e}")
+        finally:
+            state.task = None
 
-            # 警告回数を増やす
-            if user_id not in spam_warnings:
-                spam_warnings[user_id] = 0
-            spam_warnings[user_id] += 1
+    def clear(self):
+        self.channels.clear()
 
-            embed = discord.Embed(
-                title="🚫 不適切な単語検出",
-                description=f"{message.author.mention} 不適切な単語「{bad_word}」が検出されたため、メッセージを削除しました。\n警告回数: {spam_warnings[user_id]}/3",
-                color=discord.Color.red()
-            )
-            warning_msg = await message.channel.send(embed=embed)
-            await warning_msg.delete(delay=10)
+moderation_warnings = ChannelWarningAggregator()
 
-            # 3回警告でタイムアウト
-            if spam_warnings[user_id] >= 3:
-                timeout_duration = datetime.timedelta(minutes=30)
-                await message.author.timeout(timeout_duration, reason="不適切な単語の使用（3回警告）")
-                spam_warnings[user_id] = 0  # リセット
+class MessageStage:
+    """on_message の処理段階。呼び出し回数・検出回数・処理時間を記録する"""
 
-            return
-        except discord.Forbidden:
-            pass
+    def __init__(self, name, func, cost, moderation):
+        self.name = name
+        self.func = func
+        self.cost = cost  # 小さいほど軽い処理（軽い順に実行する）
+        self.moderation = moderation  # 荒らし対策の段階か（無効時は飛ばす）
+        self.reset_stats()
 
-    # スパムメッセージチェック
-    if is_spam_message(user_id, current_time):
-        try:
-            await message.delete()
+    def reset_stats(self):
+        self.calls = 0
+        self.hits = 0  # 処理を打ち切った回数
+        self.total_ns = 0
+        self.max_ns = 0
 
-            # 警告回数を増やす
-            if user_id not in spam_warnings:
-                spam_warnings[user_id] = 0
-            spam_warnings[user_id] += 1
+class MessagePipeline:
+    """メッセージの処理段階を軽い順に実行し、どれかが処理済みを返したらそこで打ち切る"""
 
-            timeout_duration = datetime.timedelta(minutes=5 * spam_warnings[user_id])  # 警告回数に応じて時間延長
-            await message.author.timeout(timeout_duration, reason="スパム行為による自動タイムアウト")
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name, cost, moderation=True):
+        # 段階を登録するデコレータ
+        def decorator(func):
+            self.stages.append(MessageStage(name, func, cost, moderation))
+            self.stages.sort(key=lambda s: s.cost)
+            return func
+        return decorator
+
+    async def run(self, message, now, guild_settings):
+        # 荒らし対策機能が無効なサーバーとDMでは対策の段階を飛ばす
+        moderation_enabled = guild_settings.anti_spam_enabled and message.guild is not None
+        for stage in self.stages:
+            if stage.moderation and not moderation_enabled:
+                continue
+            started = time.perf_counter_ns()
+            handled = await stage.func(message, now, guild_settings)
+            elapsed = time.perf_counter_ns() - started
+            stage.calls += 1
+            stage.total_ns += elapsed
+            if elapsed > stage.max_ns:
+                stage.max_ns = elapsed
+            if handled:
+                stage.hits += 1
+                return True
+        return False
+
+    def stats(self):
+        return [
+            {
+                "name": stage.name,
+                "calls": stage.calls,
+                "hits": stage.hits,
+                "avg_us": stage.total_ns / stage.calls / 1000 if stage.calls else 0.0,
+                "max_us": stage.max_ns / 1000,
+                "total_ms": stage.total_ns / 1_000_000
+            }
+            for stage in self.stages
+        ]
+
+    def reset_stats(self):
+        for stage in self.stages:
+            stage.reset_stats()
+
+message_pipeline = MessagePipeline()
+
+def delete_message(message):
+    # 同じチャンネルで短時間に消すメッセージはまとめて一括削除する
+    bulk_deletes.add(message)
+
+def timeout_member(message, duration, reason):
+    # タイムアウトを予約する（権限がなければチャンネルに警告する）
+    def on_error(e):
+        if isinstance(e, discord.Forbidden):
+            moderation_warnings.warn(message.channel, "❌ ボットにタイムアウト権限がありません")
+        else:
+            print(f"タイムアウトエラー: {e}")
+    outbound.post(PRIORITY_MODERATION, ("member", message.guild.id), message.author.timeout, duration, reason=reason, on_error=on_error)
 
-            embed = discord.Embed(
-                title="🚫 スパム検出",
-                description=f"{message.author.mention} が短時間で大量のメッセージを送信したため、{timeout_duration.total_seconds()//60}分間タイムアウトされました。",
-                color=discord.Color.red()
-            )
-            warning_msg = await message.channel.send(embed=embed)
-            await warning_msg.delete(delay=15)
+# 新規アカウント制限チェック
+@message_pipeline.stage("account_age", cost=10)
+async def account_age_stage(message, now, guild_settings):
+    account_age_days = (datetime.datetime.now() - message.author.created_at.replace(tzinfo=None)).days
+    min_account_age = guild_settings.min_account_age_days
+    if message.guild and raid_detector.in_raid(message.guild.id):
+        # レイドモード中は制限を引き上げる
+        min_account_age = max(min_account_age, guild_settings.raid_min_account_age_days)
+    if account_age_days >= min_account_age:
+        return False
+    delete_message(message)
+    moderation_warnings.warn(message.channel, f"🚫 {message.author.mention} アカウント作成から{min_account_age}日経過していないため、メッセージを削除しました")
+    return True
+
+# メンション数チェック（1通あたりと、複数のメッセージにまたがる合計）
+@message_pipeline.stage("mentions", cost=20)
+async def mention_stage(message, now, guild_settings):
+    exceeded = mention_tracker.check(message, now, guild_settings)
+    if exceeded is None:
+        return False
+    # 上限以上メンションした場合、即座にタイムアウト（設定されたタイムアウト時間を使用、デフォルト10分）
+    if exceeded == "message":
+        detail = f"1つのメッセージで{guild_settings.mention_limit}回以上メンションした"
+    else:
+        detail = f"{guild_settings.mention_window_seconds}秒以内に{guild_settings.mention_window_limit}回以上メンションした"
+    timeout_member(message, guild_settings.timeout_duration, "メンションの連投による自動タイムアウト")
+    moderation_warnings.warn(message.channel, f"⚠️ {message.author.mention} {detail}ため、{guild_settings.timeout_minutes}分間タイムアウトしました")
+
+    # メッセージを削除
+    delete_message(message)
+    return True
+
+# 送信頻度チェック（ユーザー・チャンネル・サーバー単位のトークンバケット）
+@message_pipeline.stage("rate_limit", cost=30)
+async def rate_limit_stage(message, now, guild_settings):
+    exceeded_scope = rate_limiter.check(message, now)
+    if exceeded_scope is None:
+        return False
+    user_id = message.author.id
+    if exceeded_scope == "user":
+        delete_message(message)
 
-            return
-        except discord.Forbidden:
-            embed = discord.Embed(
-                title="❌ エラー",
-                description="ボットにタイムアウト権限がありません。",
-                color=discord.Color.red()
-            )
-            await message.channel.send(embed=embed)
+        # 警告を加える（古い警告ほど減衰している）
+        strikes = max(1, round(await warning_ledger.add(message.guild.id, user_id)))
 
-    # メンションの数をカウント
-    mention_count_in_message = len(message.mentions)
+        timeout_minutes = 5 * strikes  # 警告回数に応じて時間延長
+        timeout_member(message, datetime.timedelta(minutes=timeout_minutes), "スパム行為による自動タイムアウト")
+        moderation_warnings.warn(message.channel, f"🚫 {message.author.mention} 短時間で大量のメッセージを送信したため、{timeout_minutes}分間タイムアウトしました")
+        return True
 
-    if mention_count_in_message >= 2:
-        # 2回以上メンションしている場合、即座にタイムアウト
-        try:
-            # 設定されたタイムアウト時間を使用（デフォルト10分）
-            timeout_minutes = config.get("timeout_minutes", 10)
-            timeout_duration = datetime.timedelta(minutes=timeout_minutes)
-            await message.author.timeout(timeout_duration, reason="2回以上のメンションによる自動タイムアウト")
-
-            embed = discord.Embed(
-                title="⚠️ 自動タイムアウト",
-                description=f"{message.author.mention} が1つのメッセージで2回以上メンションしたため、{timeout_minutes}分間タイムアウトされました。",
-                color=discord.Color.orange()
-            )
-            await message.channel.send(embed=embed)
+    # 複数アカウントによるチャンネル・サーバー全体の連投
+    # 賑わっているだけの通常の会話を消さないよう、レイドモード中か新規アカウントの投稿だけを削除する
+    is_new_account = discord.utils.utcnow() - message.author.created_at < guild_settings.raid_min_account_age
+    if not (raid_detector.in_raid(message.guild.id) or is_new_account):
+        return False
+    delete_message(message)
+    scope_name = "チャンネル" if exceeded_scope == "channel" else "サーバー"
+    moderation_warnings.warn(message.channel, f"🌊 この{scope_name}で短時間に大量のメッセージが送信されているため、メッセージを削除しています")
+    return True
+
+# 不適切な単語チェック
+@message_pipeline.stage("bad_words", cost=40)
+async def bad_word_stage(message, now, guild_settings):
+    contains_bad, bad_word = contains_bad_words(message.content, guild_settings)
+    if not contains_bad:
+        return False
+    user_id = message.author.id
+    delete_message(message)
+
+    # 警告を加える（古い警告ほど減衰している）
+    strikes = max(1, round(await warning_ledger.add(message.guild.id, user_id)))
+
+    moderation_warnings.warn(message.channel, f"🚫 {message.author.mention} 不適切な単語「{bad_word}」を含むメッセージを削除しました（警告 {min(strikes, 3)}/3）")
+
+    # 3回警告でタイムアウト
+    if strikes >= 3:
+        timeout_member(message, datetime.timedelta(minutes=30), "不適切な単語の使用（3回警告）")
+        warning_ledger.reset(message.guild.id, user_id)  # リセット
+
+    return True
+
+# 複数アカウントによる同一内容の投稿チェック
+@message_pipeline.stage("duplicates", cost=50)
+async def duplicate_stage(message, now, guild_settings):
+    if not duplicate_detector.check(message, now):
+        return False
+    delete_message(message)
+    moderation_warnings.warn(message.channel, "🚫 複数のアカウントから同じ内容のメッセージが短時間に投稿されたため、削除しています")
+    return True
+
+# 「ゆき」「yuki」「雪」への自動反応
+auto_reply_fired = TTLMap(ttl=AUTO_REPLY_MAX_COOLDOWN)  # ("channel", チャンネルID) / ("trigger", サーバーID, 名前) -> 最後に返信した時刻
+
+# 登録されたキーワードへの自動返信（チャンネルごと・返信ごとのクールダウン付き）
+@message_pipeline.stage("auto_reply", cost=100, moderation=False)
+async def auto_reply_stage(message, now, guild_settings):
+    keyword = guild_settings.auto_reply_matcher.search(message.content)
+    if keyword is None:
+        return False
+    reply = guild_settings.auto_reply_triggers[keyword]
+    channel_key = ("channel", message.channel.id)
+    trigger_key = ("trigger", message.guild.id if message.guild else None, reply.name)
+    last_channel = auto_reply_fired.get(channel_key)
+    last_trigger = auto_reply_fired.get(trigger_key)
+    if last_channel is not None and now - last_channel < guild_settings.auto_reply_channel_cooldown_seconds:
+        return False
+    if last_trigger is not None and now - last_trigger < reply.cooldown:
+        return False
+    auto_reply_fired[channel_key] = now
+    auto_reply_fired[trigger_key] = now
+    # 同じチャンネルへの反応が送信待ちならまとめて1回にする
+    outbound.post(PRIORITY_COSMETIC, ("send", message.channel.id), message.channel.send, embed=reply.embed, merge_key=("auto_reply", message.channel.id))
+    return False
+
+# メッセージ送信でXPを獲得（ランダムで15-25XP、クールダウン中は付与しない）
+@message_pipeline.stage("xp", cost=110, moderation=False)
+async def xp_stage(message, now, guild_settings):
+    # レベルシステムが有効かチェック
+    if guild_settings.level_system_enabled and message.guild:
+        xp_aggregator.record(message, random.randint(15, 25))
+    return False
 
-            # メッセージを削除
-            await message.delete()
+# メッセージ処理で使う現在時刻（ベンチマークでは擬似的な時計に差し替える）
+def message_clock():
+    return datetime.datetime.now().timestamp()
 
-        except discord.Forbidden:
-            embed = discord.Embed(
-                title="❌ エラー",
-                description="ボットにタイムアウト権限がありません。",
-                color=discord.Color.red()
-            )
-            await message.channel.send(embed=embed)
-        except Exception as e:
-            print(f"タイムアウトエラー: {e}")
+@bot.event
+async def on_message(message):
+    if message.author.bot:
+        return
 
-    # 「ゆき」「yuki」「雪」への自動反応
-    message_lower = message.content.lower()
-    if any(keyword in message_lower for keyword in ["ゆき", "yuki", "雪"]):
-        embed = discord.Embed(
-            title="❄️ 雪について",
-            description="雪（ゆき/yuki）は、このbotの作成者であり、とても可愛い女の子です！💕",
-            color=discord.Color.from_rgb(173, 216, 230)  # 薄い青色（雪をイメージ）
-        )
-        embed.add_field(name="特徴", value="・botの開発者\n・可愛い女の子\n・プログラミングが得意", inline=False)
-        embed.set_footer(text="雪ちゃんに感謝！ ❄️")
-        await message.channel.send(embed=embed)
+    current_time = message_clock()
 
-    # レベルシステムが有効かチェック
-    level_system_enabled = config.get("level_system_enabled", True)
-    if level_system_enabled and not message.author.bot:
-        # メッセージ送信でXPを獲得（ランダムで15-25XP）
-        xp_gain = random.randint(15, 25)
-        leveled_up, new_level = add_xp(message.author.id, xp_gain)
-
-        if leveled_up:
-            # レベルアップ通知が有効な場合のみ送信
-            levelup_notifications = config.get("levelup_notifications", True)
-            if levelup_notifications:
-                embed = discord.Embed(
-                    title="🎉 レベルアップ！",
-                    description=f"{message.author.mention} がレベル **{new_level}** に到達しました！",
-                    color=discord.Color.gold()
-                )
-                embed.set_thumbnail(url=message.author.display_avatar.url)
-                await message.channel.send(embed=embed)
+    guild_settings = await guild_configs.get(message.guild.id if message.guild else None)
+    if await message_pipeline.run(message, current_time, guild_settings):
+        return
 
     await bot.process_commands(message)
 
@@ -524,9 +2814,8 @@ class VerificationView(discord.ui.View):
             await interaction.followup.send(f"✅ 認証が完了しました！\n🎭 ロール「{self.role.name}」を付与しました。", ephemeral=True)
 
             # レベルシステムが有効な場合、認証ボーナスXPを付与
-            level_system_enabled = config.get("level_system_enabled", True)
-            if level_system_enabled:
-                leveled_up, new_level = add_xp(interaction.user.id, 100)  # 認証ボーナス100XP
+            if (await guild_configs.get(interaction.guild.id)).level_system_enabled:
+                leveled_up, new_level = await add_xp(interaction.guild.id, interaction.user.id, 100, "verification")  # 認証ボーナス100XP
                 if leveled_up:
                     await interaction.followup.send(f"🎉 認証ボーナス！レベル {new_level} に到達しました！", ephemeral=True)
 
@@ -549,11 +2838,8 @@ class VerificationView(discord.ui.View):
 # 認証コマンド
 @bot.tree.command(name='verify', description='認証パネルをこのチャンネルに設置します')
 @app_commands.describe(role='認証時に付与するロール名')
+@requires("administrator")
 async def verify(interaction: discord.Interaction, role: discord.Role):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     bot_member = interaction.guild.get_member(bot.user.id)
     if not bot_member:
         await interaction.response.send_message("❌ ボット情報を取得できませんでした。", ephemeral=True)
@@ -639,11 +2925,8 @@ async def verify(interaction: discord.Interaction, role: discord.Role):
     title="パネルのタイトル",
     description="パネルの説明"
 )
+@requires("administrator")
 async def ticket_setup(interaction: discord.Interaction, staff_role: discord.Role, category: discord.CategoryChannel, title: str = "🎫 サポートチケット", description: str = "サポートが必要な場合は、下のボタンをクリックしてチケットを作成してください。"):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     embed = discord.Embed(
         title=title,
         description=description,
@@ -671,11 +2954,8 @@ async def ticket_setup(interaction: discord.Interaction, staff_role: discord.Rol
     await interaction.response.send_message("チケットパネルを設置しました！", ephemeral=True)
 
 @bot.tree.command(name="ticket_close", description="現在のチケットを強制的に削除します")
+@requires("manage_messages")
 async def ticket_close(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     # チケットチャンネルかどうかチェック
     if not interaction.channel.name.startswith("ticket-"):
         await interaction.response.send_message("このコマンドはチケットチャンネルでのみ使用できます。", ephemeral=True)
@@ -685,11 +2965,8 @@ async def ticket_close(interaction: discord.Interaction):
     await interaction.channel.delete()
 
 @bot.tree.command(name="ticket_list", description="現在開いているチケット一覧を表示します")
+@requires("manage_messages")
 async def ticket_list(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     # チケットチャンネルを検索
     ticket_channels = [ch for ch in interaction.guild.channels if ch.name.startswith("ticket-") and isinstance(ch, discord.TextChannel)]
 
@@ -722,19 +2999,14 @@ async def ticket_list(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="timeout_config", description="自動タイムアウトの時間を設定します（分単位）")
+@requires("manage_messages")
 async def timeout_config(interaction: discord.Interaction, minutes: int):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     if minutes < 1 or minutes > 1440:  # 1分〜24時間の範囲
         await interaction.response.send_message("エラー: タイムアウト時間は1分〜1440分（24時間）の範囲で設定してください。", ephemeral=True)
         return
 
-    # 設定をconfigファイルに保存
-    config["timeout_minutes"] = minutes
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    # このサーバーの設定として保存
+    await guild_configs.update(interaction.guild.id, "timeout_config", timeout_minutes=minutes)
 
     embed = discord.Embed(
         title="⚙️ 設定完了",
@@ -744,11 +3016,8 @@ async def timeout_config(interaction: discord.Interaction, minutes: int):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="backup", description="サーバーの情報をバックアップします")
+@requires("administrator")
 async def backup(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     await interaction.response.defer(ephemeral=True)
 
     guild = interaction.guild
@@ -840,8 +3109,7 @@ async def backup(interaction: discord.Interaction):
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"backup_{guild.name}_{timestamp}.json"
 
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(backup_data, f, indent=2, ensure_ascii=False)
+    await file_io.write_json(filename, backup_data)
 
     # バックアップ完了メッセージ
     embed = discord.Embed(
@@ -856,8 +3124,7 @@ async def backup(interaction: discord.Interaction):
     )
 
     try:
-        with open(filename, "rb") as f:
-            file = discord.File(f, filename)
+        file = discord.File(io.BytesIO(await file_io.read_bytes(filename)), filename)
         await interaction.followup.send(embed=embed, file=file, ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"バックアップは完成しましたが、ファイル送信でエラーが発生しました: {e}", ephemeral=True)
@@ -907,23 +3174,15 @@ class EmbedModal(discord.ui.Modal, title="Embed作成"):
         await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="embed", description="カスタムembedメッセージを作成します")
+@requires("manage_messages")
 async def embed_command(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     await interaction.response.send_modal(EmbedModal())
 
 @bot.tree.command(name="log_channel", description="入退室ログを送信するチャンネルを設定します")
+@requires("administrator")
 async def log_channel(interaction: discord.Interaction, channel: discord.TextChannel):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
-    # 設定をconfigファイルに保存
-    config["log_channel_id"] = channel.id
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    # このサーバーの設定として保存
+    await guild_configs.update(interaction.guild.id, "log_channel", log_channel_id=channel.id)
 
     embed = discord.Embed(
         title="⚙️ ログチャンネル設定完了",
@@ -933,15 +3192,10 @@ async def log_channel(interaction: discord.Interaction, channel: discord.TextCha
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="welcome_toggle", description="DMウェルカムメッセージの有効/無効を切り替えます")
+@requires("administrator")
 async def welcome_toggle(interaction: discord.Interaction, enabled: bool):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
-    # 設定をconfigファイルに保存
-    config["welcome_dm_enabled"] = enabled
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    # このサーバーの設定として保存
+    await guild_configs.update(interaction.guild.id, "welcome_toggle", welcome_dm_enabled=enabled)
 
     status = "有効" if enabled else "無効"
     embed = discord.Embed(
@@ -952,14 +3206,9 @@ async def welcome_toggle(interaction: discord.Interaction, enabled: bool):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="anti_spam_toggle", description="荒らし対策機能の有効/無効を切り替えます")
+@requires("administrator")
 async def anti_spam_toggle(interaction: discord.Interaction, enabled: bool):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
-    config["anti_spam_enabled"] = enabled
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    await guild_configs.update(interaction.guild.id, "anti_spam_toggle", anti_spam_enabled=enabled)
 
     status = "有効" if enabled else "無効"
     embed = discord.Embed(
@@ -970,18 +3219,13 @@ async def anti_spam_toggle(interaction: discord.Interaction, enabled: bool):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="account_age_limit", description="新規アカウントの最小日数制限を設定します")
+@requires("administrator")
 async def account_age_limit(interaction: discord.Interaction, days: int):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     if days < 0 or days > 365:
         await interaction.response.send_message("エラー: 日数は0〜365の範囲で設定してください。", ephemeral=True)
         return
 
-    config["min_account_age_days"] = days
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    await guild_configs.update(interaction.guild.id, "account_age_limit", min_account_age_days=days)
 
     embed = discord.Embed(
         title="🛡️ アカウント制限設定完了",
@@ -990,18 +3234,33 @@ async def account_age_limit(interaction: discord.Interaction, days: int):
     )
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-@bot.tree.command(name="bad_words_add", description="不適切な単語を追加します")
-async def bad_words_add(interaction: discord.Interaction, word: str):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
+@bot.tree.command(name="mention_limit", description="メンション数の上限を設定します")
+@app_commands.describe(per_message="1つのメッセージでの上限", per_window="一定時間内の合計の上限", seconds="合計を数える期間（秒）")
+@requires("administrator")
+async def mention_limit(interaction: discord.Interaction, per_message: int, per_window: int, seconds: int = 60):
+    if per_message < 1 or per_window < 1 or seconds < 1 or seconds > 3600:
+        await interaction.response.send_message("エラー: 上限は1以上、期間は1〜3600秒の範囲で設定してください。", ephemeral=True)
         return
 
-    bad_words = config.get("bad_words", [])
+    await guild_configs.update(
+        interaction.guild.id, "mention_limit",
+        mention_limit=per_message, mention_window_limit=per_window, mention_window_seconds=seconds
+    )
+
+    embed = discord.Embed(
+        title="🛡️ メンション上限設定完了",
+        description=f"1つのメッセージで **{per_message}回**、{seconds}秒以内に合計 **{per_window}回** 以上メンションするとタイムアウトします。",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="bad_words_add", description="不適切な単語を追加します")
+@requires("administrator")
+async def bad_words_add(interaction: discord.Interaction, word: str):
+    bad_words = list((await guild_configs.get(interaction.guild.id)).bad_words)
     if word.lower() not in [w.lower() for w in bad_words]:
         bad_words.append(word)
-        config["bad_words"] = bad_words
-        with open("config.json", "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        await guild_configs.update(interaction.guild.id, "bad_words_add", bad_words=bad_words)
 
         embed = discord.Embed(
             title="🚫 不適切な単語追加完了",
@@ -1018,19 +3277,14 @@ async def bad_words_add(interaction: discord.Interaction, word: str):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="bad_words_remove", description="不適切な単語を削除します")
+@requires("administrator")
 async def bad_words_remove(interaction: discord.Interaction, word: str):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
-    bad_words = config.get("bad_words", [])
+    bad_words = (await guild_configs.get(interaction.guild.id)).bad_words
     original_count = len(bad_words)
     bad_words = [w for w in bad_words if w.lower() != word.lower()]
 
     if len(bad_words) < original_count:
-        config["bad_words"] = bad_words
-        with open("config.json", "w", encoding="utf-8") as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        await guild_configs.update(interaction.guild.id, "bad_words_remove", bad_words=bad_words)
 
         embed = discord.Embed(
             title="🚫 不適切な単語削除完了",
@@ -1046,16 +3300,73 @@ async def bad_words_remove(interaction: discord.Interaction, word: str):
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-@bot.tree.command(name="moderation_status", description="荒らし対策機能の現在の設定を表示します")
-async def moderation_status(interaction: discord.Interaction):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
+@bot.tree.command(name="auto_reply_add", description="キーワードへの自動返信を追加します（同じ名前なら置き換え）")
+@app_commands.describe(name="自動返信の名前", keywords="反応するキーワード（カンマ区切り）", title="返信のタイトル", description="返信の本文", cooldown="同じ返信を再び送るまでの秒数")
+@requires("administrator")
+async def auto_reply_add(interaction: discord.Interaction, name: str, keywords: str, title: str, description: str, cooldown: int = 60):
+    keyword_list = [k.strip() for k in keywords.split(",") if k.strip()]
+    if not keyword_list or cooldown < 0 or cooldown > AUTO_REPLY_MAX_COOLDOWN:
+        await interaction.response.send_message(f"エラー: キーワードを1つ以上指定し、クールダウンは0〜{AUTO_REPLY_MAX_COOLDOWN}秒の範囲で設定してください。", ephemeral=True)
         return
 
-    anti_spam = "✅ 有効" if config.get("anti_spam_enabled", True) else "❌ 無効"
-    account_age = config.get("min_account_age_days", 7)
-    timeout_minutes = config.get("timeout_minutes", 10)
-    bad_words_count = len(config.get("bad_words", []))
+    entries = [r.source for r in (await guild_configs.get(interaction.guild.id)).auto_replies if r.name != name]
+    entries.append({
+        "name": name, "keywords": keyword_list, "title": title, "description": description,
+        "color": 0xADD8E6, "fields": [], "footer": "", "cooldown_seconds": cooldown
+    })
+    await guild_configs.update(interaction.guild.id, "auto_reply_add", auto_replies=entries)
+
+    embed = discord.Embed(
+        title="💬 自動返信追加完了",
+        description=f"「{name}」を追加しました。\nキーワード: {', '.join(keyword_list)}",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="auto_reply_remove", description="自動返信を削除します")
+@requires("administrator")
+async def auto_reply_remove(interaction: discord.Interaction, name: str):
+    replies = (await guild_configs.get(interaction.guild.id)).auto_replies
+    entries = [r.source for r in replies if r.name != name]
+
+    if len(entries) < len(replies):
+        await guild_configs.update(interaction.guild.id, "auto_reply_remove", auto_replies=entries)
+        embed = discord.Embed(
+            title="💬 自動返信削除完了",
+            description=f"「{name}」を削除しました。",
+            color=discord.Color.green()
+        )
+    else:
+        embed = discord.Embed(
+            title="⚠️ 自動返信が見つかりません",
+            description=f"「{name}」という自動返信は登録されていません。",
+            color=discord.Color.orange()
+        )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="auto_reply_list", description="登録されている自動返信の一覧を表示します")
+@requires("manage_messages")
+async def auto_reply_list(interaction: discord.Interaction):
+    guild_settings = await guild_configs.get(interaction.guild.id)
+    embed = discord.Embed(
+        title="💬 自動返信一覧",
+        description=f"同じチャンネルでの返信間隔: {guild_settings.auto_reply_channel_cooldown_seconds}秒",
+        color=discord.Color.blue()
+    )
+    for reply in guild_settings.auto_replies[:25]:
+        embed.add_field(name=reply.name, value=f"{', '.join(reply.keywords)}（{reply.cooldown}秒）", inline=False)
+    if not guild_settings.auto_replies:
+        embed.add_field(name="なし", value="/auto_reply_add で追加できます", inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="moderation_status", description="荒らし対策機能の現在の設定を表示します")
+@requires("manage_messages")
+async def moderation_status(interaction: discord.Interaction):
+    guild_settings = await guild_configs.get(interaction.guild.id)
+    anti_spam = "✅ 有効" if guild_settings.anti_spam_enabled else "❌ 無効"
+    account_age = guild_settings.min_account_age_days
+    timeout_minutes = guild_settings.timeout_minutes
+    bad_words_count = len(guild_settings.bad_words)
 
     embed = discord.Embed(
         title="🛡️ 荒らし対策機能の状態",
@@ -1065,35 +3376,200 @@ async def moderation_status(interaction: discord.Interaction):
     embed.add_field(name="新規アカウント制限", value=f"{account_age}日", inline=True)
     embed.add_field(name="メンションタイムアウト", value=f"{timeout_minutes}分", inline=True)
     embed.add_field(name="不適切な単語数", value=f"{bad_words_count}個", inline=True)
-    embed.add_field(name="警告中のユーザー", value=f"{len(spam_warnings)}人", inline=True)
+    embed.add_field(name="警告中のユーザー", value=f"{await warning_ledger.active_count(interaction.guild.id)}人", inline=True)
+    embed.add_field(
+        name="メンション上限",
+        value=f"1通 {guild_settings.mention_limit}回 / {guild_settings.mention_window_seconds}秒 {guild_settings.mention_window_limit}回",
+        inline=True
+    )
+    rate_limit_text = "\n".join(
+        f"{RATE_LIMIT_SCOPE_NAMES[scope]}: {policy[0]}回 / {policy[1]}秒"
+        if policy else f"{RATE_LIMIT_SCOPE_NAMES[scope]}: 無効"
+        for scope, policy in settings.rate_limits.items()
+    )
+    embed.add_field(name="送信頻度制限", value=rate_limit_text, inline=False)
     embed.set_footer(text="設定変更は各コマンドで行えます")
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-# 権限チェック関数
-def check_command_permission(user_id: int) -> bool:
-    """コマンド使用権限をチェックする関数"""
-    allowed_users = config.get("allowed_command_users", [])
-    bot_owner_id = config.get("bot_owner_id")
+@bot.tree.command(name="rate_limit_config", description="送信頻度制限（トークンバケット）を設定します（全サーバー共通）")
+@app_commands.describe(
+    scope="制限の単位",
+    capacity="連続で送信できるメッセージ数（0で無効。チャンネル・サーバー単位はレイドモード中と新規アカウントにのみ適用）",
+    per_seconds="使い切った枠が元に戻るまでの秒数"
+)
+@app_commands.choices(scope=[
+    app_commands.Choice(name=name, value=scope) for scope, name in RATE_LIMIT_SCOPE_NAMES.items()
+])
+@requires("administrator")
+async def rate_limit_config(interaction: discord.Interaction, scope: app_commands.Choice[str], capacity: int, per_seconds: int):
+    if capacity < 0 or capacity > 1000 or per_seconds < 1 or per_seconds > 3600:
+        await interaction.response.send_message("エラー: 回数は0〜1000、秒数は1〜3600の範囲で設定してください。", ephemeral=True)
+        return
 
-    # Bot所有者は常に使用可能
-    if bot_owner_id and user_id == bot_owner_id:
-        return True
+    # 設定をconfigファイルに保存（保存時に送信頻度制限にも反映される）
+    rate_limits = copy.deepcopy(config.get("rate_limits", DEFAULT_RATE_LIMITS))
+    rate_limits[scope.value] = {"capacity": capacity, "per_seconds": per_seconds} if capacity > 0 else None
+    config_store.update("rate_limit_config", rate_limits=rate_limits)
+
+    if capacity > 0:
+        description = f"{scope.name}単位の送信頻度制限を **{per_seconds}秒あたり{capacity}回** に設定しました。"
+    else:
+        description = f"{scope.name}単位の送信頻度制限を **無効** にしました。"
+    embed = discord.Embed(
+        title="🛡️ 送信頻度制限設定完了",
+        description=description,
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+PURGE_CONCURRENCY = 5  # /purge で同時に履歴を読むチャンネル数
+
+@bot.tree.command(name="purge", description="指定したユーザーの最近のメッセージを全チャンネルから削除します")
+@app_commands.describe(user="対象のユーザー", hours="何時間前までのメッセージを削除するか", limit="チャンネルごとに確認するメッセージ数")
+@requires("manage_messages")
+async def purge(interaction: discord.Interaction, user: discord.User, hours: int = 24, limit: int = 200):
+    if hours < 1 or hours > 336 or limit < 1 or limit > 1000:
+        await interaction.response.send_message("エラー: 時間は1〜336、確認数は1〜1000の範囲で指定してください。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
 
-    # 許可されたユーザーリストに含まれているかチェック
-    return user_id in allowed_users
+    guild = interaction.guild
+    after = discord.utils.utcnow() - datetime.timedelta(hours=hours)
+    semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+    channels = [
+        c for c in guild.text_channels
+        if c.permissions_for(guild.me).read_message_history and c.permissions_for(guild.me).manage_messages
+    ]
+
+    async def purge_channel(channel):
+        # 新しい順に読み、期間外に出たら打ち切る
+        messages = []
+        async with semaphore:
+            try:
+                async for message in channel.history(limit=limit):
+                    if message.created_at < after:
+                        break
+                    if message.author.id == user.id:
+                        messages.append(message)
+            except discord.HTTPException as e:
+                print(f"履歴の取得エラー ({channel.name}): {e}")
+        return len(messages), bulk_deletes.delete(channel, messages)
+
+    results = await asyncio.gather(*(purge_channel(c) for c in channels))
+    deleted = sum(count for count, _ in results)
+    calls = sum(c for _, c in results)
+
+    embed = discord.Embed(
+        title="🧹 メッセージ削除",
+        description=f"{user.mention} の直近{hours}時間のメッセージ **{deleted}件** の削除を開始しました。",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="確認したチャンネル", value=f"{len(channels)}個", inline=True)
+    embed.add_field(name="削除リクエスト", value=f"{calls}回", inline=True)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="pipeline_stats", description="メッセージ処理の各段階の処理時間と検出回数を表示します")
+@app_commands.describe(reset="表示後に計測値をリセットするか")
+@requires("manage_messages")
+async def pipeline_stats(interaction: discord.Interaction, reset: bool = False):
+    embed = discord.Embed(
+        title="⏱️ メッセージ処理の統計",
+        description="軽い段階から順に実行し、検出した段階で処理を打ち切ります",
+        color=discord.Color.blue()
+    )
+    for stats in message_pipeline.stats():
+        embed.add_field(
+            name=stats["name"],
+            value=f"実行: {stats['calls']:,}回 / 検出: {stats['hits']:,}回\n"
+                  f"平均: {stats['avg_us']:.1f}µs / 最大: {stats['max_us']:.1f}µs\n"
+                  f"合計: {stats['total_ms']:.1f}ms",
+            inline=True
+        )
+    embed.add_field(
+        name="送信キュー",
+        value="\n".join(
+            f"{name}: 完了 {stats['done']:,} / まとめ {stats['merged']:,} / 破棄 {stats['dropped']:,}"
+            for name, stats in outbound.stats.items()
+        ) + f"\n待ち: {outbound.pending():,}件",
+        inline=False
+    )
+
+    if reset:
+        message_pipeline.reset_stats()
+        embed.set_footer(text="計測値をリセットしました")
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="config_rollback", description="設定を以前の版に戻します（版を省略すると履歴を表示）")
+@app_commands.describe(version="戻す先の版番号", shared="全サーバー共通の設定を対象にするか（Bot所有者のみ）")
+@requires("administrator")
+async def config_rollback(interaction: discord.Interaction, version: int = None, shared: bool = False):
+    if shared and "bot_owner" not in await permissions.capabilities(interaction.user, interaction.guild):
+        await interaction.response.send_message("❌ 共通の設定はBot所有者のみ戻せます。", ephemeral=True)
+        return
+
+    store = config_store if shared else await guild_configs.open(interaction.guild.id)
+
+    if version is None:
+        embed = discord.Embed(
+            title="🗂️ 設定の変更履歴",
+            description="\n".join(
+                f"**v{v}** {reason}" + (" ← 現在" if v == store.version else "")
+                for v, _, reason in reversed(store.history)
+            ),
+            color=discord.Color.blue()
+        )
+        embed.set_footer(text=f"直近{store.history.maxlen}版まで戻せます")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    if not store.rollback(version):
+        await interaction.response.send_message(f"エラー: v{version} は履歴に残っていません。", ephemeral=True)
+        return
+
+    embed = discord.Embed(
+        title="⚙️ 設定を戻しました",
+        description=f"設定を v{version} の内容に戻しました（新しい版: v{store.version}）。",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="permission_role", description="ロールにコマンドの使用権限を付与・解除します")
+@app_commands.describe(role="対象のロール", capability="付与する権限", enabled="付与するか（Falseで解除）")
+@app_commands.choices(capability=[
+    app_commands.Choice(name=name, value=capability) for capability, name in CAPABILITY_NAMES.items()
+])
+@requires("administrator")
+async def permission_role(interaction: discord.Interaction, role: discord.Role, capability: app_commands.Choice[str], enabled: bool = True):
+    guild_settings = await guild_configs.get(interaction.guild.id)
+    role_grants = {c: sorted(r) for c, r in guild_settings.role_grants.items()}
+    granted = set(role_grants.get(capability.value, []))
+    if enabled:
+        granted.add(role.id)
+    else:
+        granted.discard(role.id)
+    role_grants[capability.value] = sorted(granted)
+    await guild_configs.update(interaction.guild.id, "permission_role", role_grants=role_grants)
+
+    action = "付与" if enabled else "解除"
+    embed = discord.Embed(
+        title="🔑 権限設定完了",
+        description=f"{role.mention} の「{capability.name}」の権限を{action}しました。",
+        color=discord.Color.green() if enabled else discord.Color.orange()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="set_bot_owner", description="Bot所有者を設定します（初回のみ）")
 async def set_bot_owner(interaction: discord.Interaction):
     # 既に所有者が設定されている場合はエラー
-    if config.get("bot_owner_id"):
+    if settings.bot_owner_id:
         await interaction.response.send_message("❌ Bot所有者は既に設定されています。", ephemeral=True)
         return
 
     # 初回設定として現在のユーザーを所有者に設定
-    config["bot_owner_id"] = interaction.user.id
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    config_store.update("set_bot_owner", bot_owner_id=interaction.user.id)
 
     embed = discord.Embed(
         title="👑 Bot所有者設定完了",
@@ -1103,23 +3579,16 @@ async def set_bot_owner(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="add_command_user", description="Botコマンドの使用を許可するユーザーを追加します")
+@requires("bot_owner")
 async def add_command_user(interaction: discord.Interaction, user: discord.Member):
-    # Bot所有者のみ実行可能
-    bot_owner_id = config.get("bot_owner_id")
-    if not bot_owner_id or interaction.user.id != bot_owner_id:
-        await interaction.response.send_message("❌ このコマンドはBot所有者のみ使用できます。", ephemeral=True)
-        return
-
-    allowed_users = config.get("allowed_command_users", [])
+    allowed_users = list(config.get("allowed_command_users", []))
 
     if user.id in allowed_users:
         await interaction.response.send_message(f"⚠️ {user.mention} は既に許可されています。", ephemeral=True)
         return
 
     allowed_users.append(user.id)
-    config["allowed_command_users"] = allowed_users
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    config_store.update("add_command_user", allowed_command_users=allowed_users)
 
     embed = discord.Embed(
         title="✅ ユーザー追加完了",
@@ -1129,23 +3598,16 @@ async def add_command_user(interaction: discord.Interaction, user: discord.Membe
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="remove_command_user", description="Botコマンドの使用許可を取り消します")
+@requires("bot_owner")
 async def remove_command_user(interaction: discord.Interaction, user: discord.Member):
-    # Bot所有者のみ実行可能
-    bot_owner_id = config.get("bot_owner_id")
-    if not bot_owner_id or interaction.user.id != bot_owner_id:
-        await interaction.response.send_message("❌ このコマンドはBot所有者のみ使用できます。", ephemeral=True)
-        return
-
-    allowed_users = config.get("allowed_command_users", [])
+    allowed_users = list(config.get("allowed_command_users", []))
 
     if user.id not in allowed_users:
         await interaction.response.send_message(f"⚠️ {user.mention} は許可リストに含まれていません。", ephemeral=True)
         return
 
     allowed_users.remove(user.id)
-    config["allowed_command_users"] = allowed_users
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    config_store.update("remove_command_user", allowed_command_users=allowed_users)
 
     embed = discord.Embed(
         title="🚫 ユーザー削除完了",
@@ -1155,13 +3617,9 @@ async def remove_command_user(interaction: discord.Interaction, user: discord.Me
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="list_command_users", description="Botコマンドの使用が許可されているユーザー一覧を表示します")
+@requires("bot_owner")
 async def list_command_users(interaction: discord.Interaction):
-    # Bot所有者のみ実行可能
-    bot_owner_id = config.get("bot_owner_id")
-    if not bot_owner_id or interaction.user.id != bot_owner_id:
-        await interaction.response.send_message("❌ このコマンドはBot所有者のみ使用できます。", ephemeral=True)
-        return
-
+    bot_owner_id = settings.bot_owner_id
     allowed_users = config.get("allowed_command_users", [])
 
     embed = discord.Embed(
@@ -1195,11 +3653,8 @@ async def list_command_users(interaction: discord.Interaction):
 
 @bot.tree.command(name="chat", description="AIと会話します")
 @app_commands.describe(message="AIに送信するメッセージ")
+@requires("bot_command")
 async def chat(interaction: discord.Interaction, message: str):
-    if not check_command_permission(interaction.user.id):
-        await interaction.response.send_message("❌ このコマンドを使用する権限がありません。", ephemeral=True)
-        return
-
     if not openai_client:
         await interaction.response.send_message("❌ OpenAI APIが設定されていません。", ephemeral=True)
         return
@@ -1242,11 +3697,8 @@ async def chat(interaction: discord.Interaction, message: str):
     text="翻訳するテキスト",
     target_language="翻訳先の言語（例: EN, JA, KO, ZH, FR, DE, ES）"
 )
+@requires("bot_command")
 async def translate(interaction: discord.Interaction, text: str, target_language: str):
-    if not check_command_permission(interaction.user.id):
-        await interaction.response.send_message("❌ このコマンドを使用する権限がありません。", ephemeral=True)
-        return
-
     if not deepl_translator:
         await interaction.response.send_message("❌ DeepL APIが設定されていません。", ephemeral=True)
         return
@@ -1285,15 +3737,8 @@ async def translate(interaction: discord.Interaction, text: str, target_language
 
 @bot.tree.command(name="achievement_report", description="指定したチャンネルの実績評価と内容を送信します")
 @app_commands.describe(channel="実績を収集するチャンネル", limit="取得するメッセージ数（デフォルト：50）")
+@requires("bot_command", "manage_messages")
 async def achievement_report(interaction: discord.Interaction, channel: discord.TextChannel, limit: int = 50):
-    if not check_command_permission(interaction.user.id):
-        await interaction.response.send_message("❌ このコマンドを使用する権限がありません。", ephemeral=True)
-        return
-
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     if limit < 1 or limit > 100:
         await interaction.response.send_message("エラー: メッセージ数は1〜100の範囲で指定してください。", ephemeral=True)
         return
@@ -1535,11 +3980,10 @@ class AchievementModal(discord.ui.Modal, title="実績報告"):
             await self.target_channel.send(embed=embed)
 
             # レベルシステムが有効な場合、XPを付与
-            level_system_enabled = config.get("level_system_enabled", True)
-            if level_system_enabled:
+            if (await guild_configs.get(interaction.guild.id)).level_system_enabled:
                 # 評価に基づいてXPを計算 (高い評価ほど多くのXP)
                 xp_bonus = self_rating * 10 + difficulty * 5
-                leveled_up, new_level = add_xp(interaction.user.id, xp_bonus)
+                leveled_up, new_level = await add_xp(interaction.guild.id, interaction.user.id, xp_bonus, "achievement")
 
                 success_message = f"✅ 実績を {self.target_channel.mention} に送信しました！\n🎁 {xp_bonus}XPを獲得しました！"
 
@@ -1557,11 +4001,8 @@ class AchievementModal(discord.ui.Modal, title="実績報告"):
 
 @bot.tree.command(name="achievement_setup", description="実績報告パネルを設置します")
 @app_commands.describe(target_channel="実績を送信するチャンネル", title="パネルのタイトル", description="パネルの説明")
+@requires("manage_messages")
 async def achievement_setup(interaction: discord.Interaction, target_channel: discord.TextChannel, title: str = "実績報告", description: str = "下のボタンから実績を報告してください"):
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("エラー: このコマンドを使用するにはメッセージ管理権限が必要です。", ephemeral=True)
-        return
-
     # パネル用埋め込みメッセージ
     embed = discord.Embed(
         title=f"🏆 {title}",
@@ -1611,15 +4052,14 @@ async def achievement_setup(interaction: discord.Interaction, target_channel: di
 async def level(interaction: discord.Interaction, user: discord.Member = None):
     target_user = user or interaction.user
 
-    level_data = load_level_data()
-    user_id = str(target_user.id)
-
-    if user_id not in level_data:
-        level_data[user_id] = {"level": 1, "xp": 0}
-        save_level_data(level_data)
+    if not interaction.guild:
+        await interaction.response.send_message("❌ このコマンドはサーバー内でのみ使用できます。", ephemeral=True)
+        return
 
-    user_level = level_data[user_id]["level"]
-    user_xp = level_data[user_id]["xp"]
+    store = await level_stores.open(interaction.guild.id)
+    user_data = await store.get_async(target_user.id)
+    user_level = user_data["level"]
+    user_xp = user_data["xp"]
     xp_needed = calculate_xp_needed(user_level)
 
     # プログレスバー作成
@@ -1660,7 +4100,7 @@ async def level(interaction: discord.Interaction, user: discord.Member = None):
     )
 
     # 総XP計算
-    total_xp = sum(calculate_xp_needed(i) for i in range(1, user_level)) + user_xp
+    total_xp = calculate_total_xp(user_level, user_xp)
     embed.add_field(
         name="🏆 総経験値",
         value=f"{total_xp:,} XP",
@@ -1679,24 +4119,25 @@ async def leaderboard(interaction: discord.Interaction, limit: int = 10):
         await interaction.response.send_message("❌ 表示人数は1〜20人の範囲で指定してください。", ephemeral=True)
         return
 
-    level_data = load_level_data()
+    if not interaction.guild:
+        await interaction.response.send_message("❌ このコマンドはサーバー内でのみ使用できます。", ephemeral=True)
+        return
+
+    rank_index = await get_rank_index(interaction.guild)
 
-    if not level_data:
+    if not len(rank_index):
         await interaction.response.send_message("❌ レベルデータが見つかりません。", ephemeral=True)
         return
 
-    # 総XPでソート
+    # 順位インデックスから上位のメンバーを取得（インデックスには現在のメンバーだけが入っている）
     user_scores = []
-    for user_id, data in level_data.items():
-        user = interaction.guild.get_member(int(user_id))
-        if user and not user.bot:
-            level = data["level"]
-            current_xp = data["xp"]
-            total_xp = sum(calculate_xp_needed(i) for i in range(1, level)) + current_xp
+    for user_id, total_xp in rank_index.iter_top():
+        user = interaction.guild.get_member(user_id)
+        if user:
+            level, _ = level_from_total_xp(total_xp)
             user_scores.append((user, level, total_xp))
-
-    # 総XPでソート
-    user_scores.sort(key=lambda x: x[2], reverse=True)
+            if len(user_scores) >= limit:
+                break
 
     embed = discord.Embed(
         title="🏆 レベルランキング",
@@ -1731,20 +4172,17 @@ async def leaderboard(interaction: discord.Interaction, limit: int = 10):
         )
 
     # 自分の順位を表示
-    user_rank = None
-    for i, (user, level, total_xp) in enumerate(user_scores):
-        if user.id == interaction.user.id:
-            user_rank = i + 1
-            break
+    user_rank = rank_index.rank(interaction.user.id)
+    total_users = len(rank_index)
 
     if user_rank:
         embed.add_field(
             name="🎯 あなたの順位",
-            value=f"{user_rank}位 / {len(user_scores)}人",
+            value=f"{user_rank}位 / {total_users}人",
             inline=True
         )
 
-    embed.set_footer(text=f"総参加者数: {len(user_scores)}人")
+    embed.set_footer(text=f"総参加者数: {total_users}人")
     embed.timestamp = discord.utils.utcnow()
 
     await interaction.response.send_message(embed=embed)
@@ -1754,27 +4192,26 @@ async def leaderboard(interaction: discord.Interaction, limit: int = 10):
     enabled="レベルシステムを有効にするか",
     notifications="レベルアップ通知を有効にするか"
 )
+@requires("administrator")
 async def level_config(interaction: discord.Interaction, enabled: bool = None, notifications: bool = None):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     changes = []
+    updates = {}
 
     if enabled is not None:
-        config["level_system_enabled"] = enabled
+        updates["level_system_enabled"] = enabled
         status = "有効" if enabled else "無効"
         changes.append(f"レベルシステム: **{status}**")
 
     if notifications is not None:
-        config["levelup_notifications"] = notifications
+        updates["levelup_notifications"] = notifications
         status = "有効" if notifications else "無効"
         changes.append(f"レベルアップ通知: **{status}**")
 
     if not changes:
         # 現在の設定を表示
-        level_enabled = config.get("level_system_enabled", True)
-        notif_enabled = config.get("levelup_notifications", True)
+        guild_settings = await guild_configs.get(interaction.guild.id)
+        level_enabled = guild_settings.level_system_enabled
+        notif_enabled = guild_settings.levelup_notifications
 
         embed = discord.Embed(
             title="⚙️ レベルシステム設定",
@@ -1796,8 +4233,7 @@ async def level_config(interaction: discord.Interaction, enabled: bool = None, n
         return
 
     # 設定を保存
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=2, ensure_ascii=False)
+    await guild_configs.update(interaction.guild.id, "level_config", **updates)
 
     embed = discord.Embed(
         title="⚙️ レベルシステム設定変更完了",
@@ -1809,11 +4245,8 @@ async def level_config(interaction: discord.Interaction, enabled: bool = None, n
 
 @bot.tree.command(name="add_xp", description="指定したユーザーにXPを付与します（管理者のみ）")
 @app_commands.describe(user="XPを付与するユーザー", amount="付与するXP量")
+@requires("administrator")
 async def add_xp_command(interaction: discord.Interaction, user: discord.Member, amount: int):
-    if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("❌ このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-        return
-
     if amount < 1 or amount > 10000:
         await interaction.response.send_message("❌ XP量は1〜10000の範囲で指定してください。", ephemeral=True)
         return
@@ -1823,7 +4256,7 @@ async def add_xp_command(interaction: discord.Interaction, user: discord.Member,
         return
 
     # XPを付与
-    leveled_up, new_level = add_xp(user.id, amount)
+    leveled_up, new_level = await add_xp(interaction.guild.id, user.id, amount, "admin")
 
     embed = discord.Embed(
         title="🎁 XP付与完了",
@@ -1845,15 +4278,8 @@ async def add_xp_command(interaction: discord.Interaction, user: discord.Member,
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="nuke", description="現在のチャンネルを削除し、同じ設定のチャンネルを再作成します。")
+@requires("bot_command", "administrator")
 async def nuke(interaction: discord.Interaction):
-    if not check_command_permission(interaction.user.id):
-        await interaction.response.send_message("❌ このコマンドを使用する権限がありません。", ephemeral=True)
-        return
-
-    if not interaction.user.guild_permissions.administrator:
-         await interaction.response.send_message("エラー: このコマンドを使用するには管理者権限が必要です。", ephemeral=True)
-         return 
-
     channel = interaction.channel
     if not isinstance(channel, discord.TextChannel):
         await interaction.response.send_message("エラー: このコマンドはテキストチャンネルでのみ使用できます。", ephemeral=True)